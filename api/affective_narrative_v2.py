@@ -4,13 +4,13 @@ V2 use Q and A that summarize the mean of each field by year
 
 import logging
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Response, status
 from pydantic import BaseModel
-import asyncio
 
+from job_scheduler import JobScheduler, JobQueueFullError, PRIORITY_NORMAL
 from services.llm_summarize_story import llm_summarize_story_v2
 
-from services.redis_util import get_description_from_redis
+from services.redis_util import get_session_state
 
 router = APIRouter()
 
@@ -20,26 +20,38 @@ class Agency(BaseModel):
     intensity_level: int
     word_count: int
     purpose: str
+    stream: bool = False  # forward the tokens while they are generated
 
-async def affective_narrative_pipeline_v2(session_id, description, agency: Agency):
+async def affective_narrative_pipeline_v2(session_id, core_concept, agency: Agency):
     try:
-        await llm_summarize_story_v2(session_id, agency)
+        await llm_summarize_story_v2(session_id, agency, core_concept)
         
     except Exception as e:
         logging.error(f"Error in affective_narrative pipeline: {e}")
+        raise
 
 @router.post("/v2/generate-affective-narrative/{session_id}", status_code=status.HTTP_202_ACCEPTED)
 async def generate_affective_narrative(
     session_id: str, 
-    agency: Agency
+    agency: Agency,
+    response: Response
     ):
 
     logging.info("Generating affective narrative v2...")
     logging.info(session_id)
     logging.info(agency)
 
-    description = get_description_from_redis(session_id) 
-    asyncio.create_task(affective_narrative_pipeline_v2(session_id, description, agency))
-
-    return {"status": "processing"}
+    # One Redis round trip for the whole request
+    state = await get_session_state(session_id, "core_concept", "description")
+    core_concept = state["core_concept"] or state["description"]
+    try:
+        job = JobScheduler.submit(
+            "narrative", session_id, affective_narrative_pipeline_v2, session_id, core_concept, agency, priority=PRIORITY_NORMAL
+        )
+    except JobQueueFullError as e:
+        logging.warning(f"[API] Rejecting narrative: {e}")
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    return {"status": "processing", "job_id": job.id}
 
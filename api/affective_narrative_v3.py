@@ -1,10 +1,10 @@
 
 import logging
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Response, status
 from pydantic import BaseModel
-import asyncio
 
+from job_scheduler import JobScheduler, JobQueueFullError, PRIORITY_LOW
 from services.llm_summarize_story_v3 import llm_summarize_story_v3
 
 from services.redis_util import get_description_from_redis
@@ -17,6 +17,7 @@ class Agency(BaseModel):
     intensity_level: str 
     word_count: int
     purpose: str
+    stream: bool = False  # forward the tokens while they are generated
 
 async def affective_narrative_pipeline_v3(session_id, description, agency: Agency):
     try:
@@ -24,19 +25,28 @@ async def affective_narrative_pipeline_v3(session_id, description, agency: Agenc
         
     except Exception as e:
         logging.error(f"Error in affective_narrative pipeline: {e}")
+        raise
 
 @router.post("/v3/generate-affective-narrative/{session_id}", status_code=status.HTTP_202_ACCEPTED)
 async def generate_affective_narrative(
     session_id: str, 
-    agency: Agency
+    agency: Agency,
+    response: Response
     ):
 
     logging.info("Generating affective narrative v3...")
     logging.info(session_id)
     logging.info(agency)
 
-    description = get_description_from_redis(session_id) 
-    asyncio.create_task(affective_narrative_pipeline_v3(session_id, description, agency))
-
-    return {"status": "processing"}
+    description = await get_description_from_redis(session_id) 
+    try:
+        job = JobScheduler.submit(
+            "narrative", session_id, affective_narrative_pipeline_v3, session_id, description, agency, priority=PRIORITY_LOW
+        )
+    except JobQueueFullError as e:
+        logging.warning(f"[API] Rejecting narrative: {e}")
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    return {"status": "processing", "job_id": job.id}
 
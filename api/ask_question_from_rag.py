@@ -1,5 +1,6 @@
 import logging
 import json
+import asyncio
 
 from fastapi import APIRouter, Response
 from pydantic import BaseModel
@@ -7,11 +8,8 @@ from pydantic import BaseModel
 from pathlib import Path
 from services.rag_v2 import chunking_and_embedding, ask_llm_with_rag
 from ws.websocket import websocket_manager 
+from vector_store_manager import VectorStoreManager
 
-from chromadb.config import Settings
-from chromadb import Client
-
-chroma_client = Client(Settings())
 router = APIRouter()
 
 logging.basicConfig(level = logging.INFO)
@@ -27,16 +25,14 @@ async def ask_question_from_rag(
         item: Item,
     ):
 
-    try:
-        chroma_client.get_collection(name=session_id)
-    except:
+    if VectorStoreManager.get_collection(session_id) is None:
         session_dir = UPLOAD_ROOT/session_id
         stat_file_path = session_dir / "stat.json"
 
-        chunking_and_embedding(stat_file_path, session_id)
+        await asyncio.to_thread(chunking_and_embedding, stat_file_path, session_id)
     
 
-    res = ask_llm_with_rag(session_id, item.question)
+    res = await ask_llm_with_rag(session_id, item.question)
 
     logging.info(f"Response {res}")
     
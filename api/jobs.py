@@ -0,0 +1,21 @@
+import logging
+
+from fastapi import APIRouter, Response, status
+
+from job_scheduler import JobScheduler
+
+router = APIRouter()
+
+logging.basicConfig(level = logging.INFO)
+
+
+@router.get("/jobs/{session_id}")
+def get_jobs(session_id: str, response: Response):
+    jobs = JobScheduler.get_jobs(session_id)
+    if not jobs:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"error": "no job found for this session"}
+
+    return {
+        "data": [job.to_dict() for job in jobs]
+    }
@@ -0,0 +1,22 @@
+import logging
+
+from fastapi import APIRouter
+
+from services.embedding_cache import embedding_cache
+from vector_store_manager import VectorStoreManager
+from job_scheduler import JobScheduler
+
+router = APIRouter()
+
+logging.basicConfig(level = logging.INFO)
+
+
+@router.get("/metrics")
+def get_metrics():
+    return {
+        "data": {
+            "embedding_cache": embedding_cache.stats(),
+            "vector_store": VectorStoreManager.stats(),
+            "jobs": JobScheduler.stats()
+        }
+    }
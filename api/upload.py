@@ -1,14 +1,22 @@
+import asyncio
 import logging
 import json
-import asyncio
-
-import pandas as pd
+import hashlib
+import uuid
+import weakref
 
 from fastapi import APIRouter, UploadFile, File, Form, Response, status
 from pathlib import Path
 
-from redis_manager import RedisManager
-from services.generate_stat import generate_descriptive_stats
+from process_pool_manager import ProcessPoolManager, PoolBusyError
+from job_scheduler import JobScheduler, JobQueueFullError
+from services.stream_stat import STAT_STATE_FILE_NAME, write_descriptive_stats
+from services.append_stat import append_descriptive_stats
+from services.date_format import clear_session_date_format
+from services.graph_cache import save_dataset_hash, clear_column_hashes
+from services.columnar import columnar_path, clear_columnar_parts
+from services.rag_v2 import refresh_stat_chunks
+from services.redis_util import set_session_state
 from services.llm_recommend_emotion import llm_emotion_recommendation
 from ws.websocket import websocket_manager
 
@@ -16,23 +24,35 @@ router = APIRouter()
 
 logging.basicConfig(level = logging.INFO)
 UPLOAD_ROOT = Path("uploaded_files")
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# session_id -> lock, uploads and appends to the same session run one at a time
+_session_locks = weakref.WeakValueDictionary()
+
 
+def session_lock(session_id):
+    return _session_locks.setdefault(session_id, asyncio.Lock())
 
-async def prepare_stat(df: pd.DataFrame, stat_file_path):
+
+def prepare_stat(csv_file_path, stat_file_path, session_id):
+    """
+    prepare_stat
+    submit the stats job to the process pool, raise PoolBusyError when the pool is full
+    the job also writes the columnar copy of the dataset and the aggregates
+    used by later appends
+    """
     logging.info("[API] Preparing statistics for the uploaded file")
-    res = generate_descriptive_stats(df)
-    
-    with open(stat_file_path, "w") as f:
-        f.write(json.dumps(res, indent=4))
-    
-    logging.info("[API] Done preparing statistics for the uploaded file")
+    session_dir = csv_file_path.parent
+    return ProcessPoolManager.submit(
+        write_descriptive_stats, csv_file_path, stat_file_path, session_id,
+        columnar_path(session_dir), session_dir/STAT_STATE_FILE_NAME
+    )
 
     
-async def upload_pipeline(df, session_dir, session_id, description):
-    stat_file_path = session_dir / "stat.json"
-
+async def upload_pipeline(stat_job, session_id, description):
     try:
-        await prepare_stat(df, stat_file_path) 
+        await stat_job
+        logging.info("[API] Done preparing statistics for the uploaded file")
         await llm_emotion_recommendation(session_id, description)
     except Exception as e:
         logging.error(f"Error in upload pipeline: {e}")
@@ -43,6 +63,7 @@ async def upload_pipeline(df, session_dir, session_id, description):
             "result": "error"
         }
     }))
+        raise
 
 
 
@@ -66,30 +87,122 @@ async def upload_file_and_description(
     if file.content_type != "text/csv":
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"error": "accept only CSV file"}
+    if ProcessPoolManager.is_full() or JobScheduler.is_full("upload"):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
     
 
     session_dir = UPLOAD_ROOT/session_id
     session_dir.mkdir(parents=True, exist_ok=True)
     csv_file_path = session_dir / "data.csv"
-
-    ## Save to temp folder
-    with open(csv_file_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    stat_file_path = session_dir / "stat.json"
+    clear_session_date_format(session_id)
+
+    # Held while the files of the previous dataset are replaced, an append
+    # waiting on the lock then finds no stats state and is rejected
+    async with session_lock(session_id):
+        # Left from appends to the previous dataset of the session
+        (session_dir/STAT_STATE_FILE_NAME).unlink(missing_ok=True)
+        clear_columnar_parts(session_dir)
+        clear_column_hashes(session_dir)
+
+        ## Save to temp folder, chunk by chunk so the whole file is never in memory
+        # The hash of the data is the key of the graph cache
+        sha256 = hashlib.sha256()
+        with open(csv_file_path, "wb") as f:
+            while content := await file.read(UPLOAD_CHUNK_SIZE):
+                f.write(content)
+                sha256.update(content)
+        save_dataset_hash(session_dir, sha256.hexdigest())
     
-    value = {
+    await set_session_state(session_id, status="processing", description=description)
+
+    logging.info("[API] Upload the file and description")
+
+    try:
+        stat_job = prepare_stat(csv_file_path, stat_file_path, session_id)
+    except PoolBusyError as e:
+        logging.warning(f"[API] Rejecting upload: {e}")
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    try:
+        job = JobScheduler.submit("upload", session_id, upload_pipeline, stat_job, session_id, description)
+    except JobQueueFullError as e:
+        logging.warning(f"[API] Rejecting upload: {e}")
+        stat_job.cancel()
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    return {
         "status": "processing",
-        "description": description
+        "job_id": job.id
     }
-    redis_client = RedisManager.get_client()
-    redis_client.set(session_id, json.dumps(value))
-    redis_client.expire(session_id, 20*60)  # Set expiration time to 20 minutes
 
-    logging.info("[API] Upload the file and description")
 
-    df = pd.read_csv(csv_file_path)
-    asyncio.create_task(upload_pipeline(df, session_dir, session_id, description))
-    
+@router.post("/upload/append")
+async def append_file(
+    response: Response,
+    session_id: str = Form(None),
+    file: UploadFile = File(None)
+):
+    """
+    append_file
+    append the rows of a CSV with the same columns to the dataset of the
+    session, the stats are updated from the new rows only
+    """
+    ## Check the input
+    if file is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": "missing file"}
+    if session_id is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": "missing session_id"}
+    if file.content_type != "text/csv":
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": "accept only CSV file"}
+
+    session_dir = UPLOAD_ROOT/session_id
+    if not (session_dir/STAT_STATE_FILE_NAME).exists():
+        response.status_code = status.HTTP_409_CONFLICT
+        return {"error": "the statistics of the dataset are not ready, upload the dataset first"}
+    if ProcessPoolManager.is_full():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    async with session_lock(session_id):
+        # Checked again, an upload may have replaced the dataset while waiting
+        if not (session_dir/STAT_STATE_FILE_NAME).exists():
+            response.status_code = status.HTTP_409_CONFLICT
+            return {"error": "the statistics of the dataset are not ready, upload the dataset first"}
+
+        append_file_path = session_dir/f"append-{uuid.uuid4().hex}.csv"
+        try:
+            with open(append_file_path, "wb") as f:
+                while content := await file.read(UPLOAD_CHUNK_SIZE):
+                    f.write(content)
+
+            result = await ProcessPoolManager.submit(append_descriptive_stats, session_dir, append_file_path, session_id)
+        except PoolBusyError as e:
+            logging.warning(f"[API] Rejecting append: {e}")
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            return {"error": "server is busy, try again later"}
+        except ValueError as e:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"error": str(e)}
+        finally:
+            append_file_path.unlink(missing_ok=True)
+
+        logging.info(f"[API] Appended {result['rows']} rows to session {session_id}")
+
+        # The narratives are cached by the hash of stat.json and the graphs by
+        # the hash of their column, only the RAG chunks are updated here
+        try:
+            await asyncio.to_thread(refresh_stat_chunks, session_dir/"stat.json", session_id)
+        except Exception as e:
+            logging.error(f"[API] Cannot update the RAG chunks of session {session_id}: {e}")
+
     return {
-        "status": "processing"
-    }
\ No newline at end of file
+        "status": "done",
+        "data": result
+    }
@@ -1,82 +1,224 @@
+import asyncio
 import logging
 import os
+import uuid
 import zipfile
-import random
+import zlib
 
-from fastapi import APIRouter, status, Body
+from fastapi import APIRouter, Response, status, Body
 from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 from pathlib import Path
 
-import seaborn as sns
+import matplotlib
+matplotlib.use("Agg")  # no GUI backend in the workers
+
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import numpy as np
 import pandas as pd
 
+from process_pool_manager import ProcessPoolManager, PoolBusyError
+from services.generate_stat import get_date_field
+from services.date_format import parse_session_dates
+from services.columnar import read_columns
+from services.stat_store import load_stat
+from util.downsample import downsample_indices
+from services.graph_cache import get_column_hashes, graph_cache_key, lookup_graph, store_graph, evict_graphs
+
 logging.basicConfig(level = logging.INFO)
 router = APIRouter()
 
 UPLOAD_ROOT = Path("uploaded_files")
-
-def timeseries_graph(df, session_id, date_field, column, colors_list):
-    fig, ax = plt.subplots(figsize=(12, 6))
-
-    # Plot using Seaborn on the given axes
-    if colors_list:
-        # randomly select a color for single line plots
-        random_color = random.randint(0, len(colors_list) - 1)
-        sns.lineplot(ax=ax, x=date_field, y=column, data=df, color=colors_list[random_color])  # Use first color for single line
-    else:
-        sns.lineplot(ax=ax, x=date_field, y=column, data=df)
+GRAPH_DPI = int(os.getenv("GRAPH_DPI", 300))
+GRAPH_FIGSIZE = (12, 6)
+# minmax or lttb, series longer than about 2 points per pixel are downsampled
+GRAPH_DOWNSAMPLE_METHOD = os.getenv("GRAPH_DOWNSAMPLE_METHOD", "minmax")
+
+def get_max_points(dpi):
+    return 2 * int(GRAPH_FIGSIZE[0] * dpi)
+
+def plot_series(ax, dates, values, color=None, max_points=None):
+    """
+    plot_series
+    draw one line sorted by date, repeated dates are averaged with a 95% band
+    (normal approximation instead of the seaborn bootstrap)
+    series longer than max_points are downsampled first
+    """
+    series = pd.Series(values.to_numpy(), index=dates.to_numpy()).dropna()
+    series = series[series.index.notna()].sort_index()
+
+    if series.index.is_unique:
+        x, y = series.index.to_numpy(), series.to_numpy()
+        if max_points:
+            keep = downsample_indices(x, y, max_points, GRAPH_DOWNSAMPLE_METHOD)
+            x, y = x[keep], y[keep]
+        ax.plot(x, y, color=color)
+        return
+
+    grouped = series.groupby(level=0).agg(["mean", "std", "count"])
+    margin = 1.96 * (grouped["std"] / np.sqrt(grouped["count"])).fillna(0)
+    x, y, margin = grouped.index.to_numpy(), grouped["mean"].to_numpy(), margin.to_numpy()
+    if max_points:
+        keep = downsample_indices(x, y, max_points, GRAPH_DOWNSAMPLE_METHOD)
+        x, y, margin = x[keep], y[keep], margin[keep]
+
+    lines = ax.plot(x, y, color=color)
+    ax.fill_between(x, y - margin, y + margin, color=lines[0].get_color(), alpha=0.2, linewidth=0)
+
+def pick_color(column, colors_list):
+    """
+    pick_color
+    pick a color of the palette for the column, always the same one for
+    the same column so the rendered graph can be cached
+    """
+    if not colors_list:
+        return None
+    return colors_list[zlib.crc32(column.encode()) % len(colors_list)]
+
+def timeseries_graph(ax, dates, values, column, color, max_points=None):
+    ax.clear()
+    plot_series(ax, dates, values, color=color, max_points=max_points)
 
     # Add title and format x-axis
     ax.set_title(f"Daily {column} Over Time", fontsize=16)
+    ax.set_xlabel(dates.name)
+    ax.set_ylabel(column)
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-    plt.xticks(rotation=45)
-
-    # Save to file
-    output_path = f"./uploaded_files/{session_id}/graph/{column}.png"
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    plt.close(fig)  # Close this specific figure
-
-def generate_graph_from_files(session_dir, session_id, colors_list):
-    # Ensure date column is datetime
-    data_dir = session_dir/"data.csv"
-    df = pd.read_csv(data_dir)
-
-    possible_date_field = ['date', 'timestamp', 'timestamps', 'Date']
-    fields = df.dtypes.index
-    for field_name in possible_date_field:
-        if field_name in fields:
-            date_field = field_name
-
-    df[date_field] = pd.to_datetime(df[date_field], errors="coerce")
-    for col_name, col_type in df.dtypes.items():
-        logging.info(f"Col type: {col_type}")
-        logging.info(pd.api.types.is_numeric_dtype(col_type))
-
+    ax.tick_params(axis="x", labelrotation=45)
+
+def render_columns(session_dir, session_id, date_field, column_colors, dpi):
+    """
+    render_columns
+    draw the graph of each column with its color, runs in a process pool worker
+    one figure is reused for every column of the batch
+    """
+    # Memory-mapped columns with parsed dates, the CSV until the Arrow file is written
+    df = read_columns(session_dir, [date_field, *column_colors])
+    if df is None:
+        df = pd.read_csv(session_dir/"data.csv", usecols=[date_field, *column_colors])
+        df[date_field] = parse_session_dates(session_id, df[date_field])
+    dates = df[date_field]
+
+    fig, ax = plt.subplots(figsize=GRAPH_FIGSIZE)
+    for column, color in column_colors.items():
+        logging.info(f"Generating graph for column: {column}")
+        timeseries_graph(ax, dates, df[column], column, color, get_max_points(dpi))
+
+        # Write a new file, the old one may be a link to a cached graph. The
+        # name is unique, concurrent requests may render the same column
+        output_path = session_dir/"graph"/f"{column}.png"
+        tmp_path = session_dir/"graph"/f"{column}.png.{uuid.uuid4().hex}.tmp"
+        fig.savefig(tmp_path, dpi=dpi, bbox_inches='tight', format="png")
+        os.replace(tmp_path, output_path)
+
+    plt.close(fig)
+
+def get_numeric_fields(date_field, fields):
+    return [
+        field for field, field_type in fields.items()
+        if field != date_field and pd.api.types.is_numeric_dtype(np.dtype(field_type))
+    ]
+
+def get_fields(session_dir):
+    """
+    get_fields
+    return the column types from stat.json, or from the head of data.csv
+    when the stats are not ready yet
+    """
+    stat_file_path = session_dir/"stat.json"
+    if stat_file_path.exists():
+        return load_stat(stat_file_path)["data"]["fields"]
+
+    dtypes = pd.read_csv(session_dir/"data.csv", nrows=10_000).dtypes
+    return {field: str(field_type) for field, field_type in dtypes.items()}
+
+def write_zip(zip_path, paths):
+    with zipfile.ZipFile(zip_path, "w") as zipf:
+        for path in paths:
+            zipf.write(path, arcname=os.path.basename(path))  # arcname removes folder path in ZIP
 
-        if pd.api.types.is_numeric_dtype(col_type):
-            logging.info(f"Generating graph for column: {col_name}")
-            timeseries_graph(df, session_id, date_field, col_name, colors_list)
+async def generate_graph_from_files(session_dir, session_id, colors_list, dpi=GRAPH_DPI):
+    """
+    generate_graph_from_files
+    link the cached graphs and render the missing ones, split into one batch
+    per worker rendered in parallel
+    return the graphed columns and the number of cache hits and misses
+    """
+    # File reads and hashing run in threads, a legacy session hashes the whole data.csv
+    fields = await asyncio.to_thread(get_fields, session_dir)
+    date_field = get_date_field(fields)
+    columns = get_numeric_fields(date_field, fields)
+    column_hashes = await asyncio.to_thread(get_column_hashes, session_dir, columns)
+
+    keys = {}
+    missing = {}
+    for column in columns:
+        color = pick_color(column, colors_list)
+        keys[column] = graph_cache_key(column_hashes[column], column, color, GRAPH_FIGSIZE, dpi, GRAPH_DOWNSAMPLE_METHOD)
+        if not lookup_graph(keys[column], session_dir/"graph"/f"{column}.png"):
+            missing[column] = color
+
+    hits, misses = len(columns) - len(missing), len(missing)
+    logging.info(f"[generate_graph_from_files] Graph cache hits: {hits}, misses: {misses}")
+    if not missing:
+        return columns, hits, misses
+
+    missing_columns = list(missing)
+    num_batches = min(len(missing_columns), ProcessPoolManager.max_workers)
+    batches = [missing_columns[i::num_batches] for i in range(num_batches)]
+
+    jobs = ProcessPoolManager.submit_many(render_columns, [
+        (session_dir, session_id, date_field, {column: missing[column] for column in batch}, dpi)
+        for batch in batches
+    ])
+    await asyncio.gather(*jobs)
+
+    for column in missing_columns:
+        store_graph(keys[column], session_dir/"graph"/f"{column}.png")
+    await asyncio.to_thread(evict_graphs)
+
+    return columns, hits, misses
 
 
 @router.post("/visualization/{session_id}", status_code=status.HTTP_202_ACCEPTED)
-def visualization(session_id: str, colors: str = Body(..., embed=True)):
+async def visualization(
+    response: Response,
+    session_id: str,
+    colors: str = Body(..., embed=True),
+    dpi: int = Body(GRAPH_DPI, embed=True, ge=50, le=600)
+):
     session_dir = UPLOAD_ROOT/session_id
-    graph_dir = session_dir/"graph" 
+    graph_dir = session_dir/"graph"
     graph_dir.mkdir(parents=True, exist_ok=True)
 
     colors_list = [color.strip() for color in colors.split(',')]
 
-    generate_graph_from_files(session_dir, session_id, colors_list)
-
-    image_paths = [os.path.join(graph_dir, f) for f in os.listdir(graph_dir) if f.endswith(".png")]
-    zip_path = "/tmp/images_bundle.zip"
-
-    with zipfile.ZipFile(zip_path, "w") as zipf:
-        for path in image_paths:
-            zipf.write(path, arcname=os.path.basename(path))  # arcname removes folder path in ZIP
-
-    return FileResponse(zip_path, media_type='application/zip', filename="data_visualizations.zip")
+    try:
+        columns, hits, misses = await generate_graph_from_files(session_dir, session_id, colors_list, dpi)
+    except PoolBusyError as e:
+        logging.warning(f"[API] Rejecting visualization: {e}")
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"error": "server is busy, try again later"}
+
+    image_paths = [graph_dir/f"{column}.png" for column in columns]
+    # One bundle per request so concurrent requests do not overwrite each
+    # other, removed once it has been sent
+    zip_path = session_dir/f"data_visualizations.{uuid.uuid4().hex}.zip"
+    try:
+        await asyncio.to_thread(write_zip, zip_path, image_paths)
+    except Exception:
+        zip_path.unlink(missing_ok=True)
+        raise
+
+    return FileResponse(
+        zip_path,
+        media_type='application/zip',
+        filename="data_visualizations.zip",
+        headers={
+            "X-Graph-Cache-Hits": str(hits),
+            "X-Graph-Cache-Misses": str(misses),
+        },
+        background=BackgroundTask(zip_path.unlink, missing_ok=True)
+    )
@@ -0,0 +1,193 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+import uuid
+
+from collections import deque
+from dotenv import load_dotenv
+
+from redis_manager import SESSION_TTL
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+# Lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+# Finished jobs kept per session for the status endpoint
+JOB_HISTORY_SIZE = 20
+
+
+class JobQueueFullError(Exception):
+    """Raised when the queue of a job kind is full"""
+
+
+class Job:
+    def __init__(self, kind, session_id, priority):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.priority = priority
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobScheduler:
+    """
+    Runs the background pipelines (upload, narratives) on a fixed pool of
+    worker tasks per job kind instead of one unbounded task per request.
+
+    Each kind has its own priority queue, at most `workers` jobs of a kind
+    run at once and `max_queue` more can wait, submit raises
+    JobQueueFullError beyond that. The jobs of each session are kept for
+    the status endpoint until SESSION_TTL after they finish.
+    """
+    kinds = {
+        "upload": {
+            "workers": int(os.getenv("JOB_UPLOAD_WORKERS", 2)),
+            "max_queue": int(os.getenv("JOB_UPLOAD_QUEUE_SIZE", 32)),
+        },
+        "narrative": {
+            "workers": int(os.getenv("JOB_NARRATIVE_WORKERS", 4)),
+            "max_queue": int(os.getenv("JOB_NARRATIVE_QUEUE_SIZE", 64)),
+        },
+    }
+
+    _queues = {}
+    _workers = []
+    _running = {}
+    _counters = {}
+    _jobs = {}  # session_id -> deque of Job, oldest first
+    _sequence = itertools.count()  # keeps FIFO order within a priority
+    _stopping = False  # set by shutdown, the workers are being cancelled
+
+    @classmethod
+    def start(cls):
+        if cls._workers:
+            return
+
+        for kind, config in cls.kinds.items():
+            cls._queues[kind] = asyncio.PriorityQueue(maxsize=config["max_queue"])
+            cls._running[kind] = 0
+            cls._counters[kind] = {"completed": 0, "failed": 0}
+            for _ in range(config["workers"]):
+                cls._workers.append(asyncio.create_task(cls._worker(kind)))
+        logging.info(f"[JobScheduler] Started {len(cls._workers)} workers")
+
+    @classmethod
+    def submit(cls, kind, session_id, fn, *args, priority=PRIORITY_NORMAL) -> Job:
+        """
+        submit
+        queue fn(*args) as a job of the given kind, raise JobQueueFullError when the queue is full
+        """
+        cls.start()
+        if kind not in cls._queues:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {list(cls.kinds)}")
+
+        job = Job(kind, session_id, priority)
+        try:
+            cls._queues[kind].put_nowait((priority, next(cls._sequence), job, fn, args))
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"{cls._queues[kind].qsize()} {kind} jobs already queued")
+
+        cls._remember(job)
+        return job
+
+    @classmethod
+    def is_full(cls, kind):
+        return kind in cls._queues and cls._queues[kind].full()
+
+    @classmethod
+    def get_jobs(cls, session_id):
+        cls._forget_expired()
+        return list(cls._jobs.get(session_id, []))
+
+    @classmethod
+    def stats(cls):
+        return {
+            kind: {
+                "workers": config["workers"],
+                "running": cls._running.get(kind, 0),
+                "queue_depth": cls._queues[kind].qsize() if kind in cls._queues else 0,
+                "max_queue": config["max_queue"],
+                **cls._counters.get(kind, {"completed": 0, "failed": 0}),
+            }
+            for kind, config in cls.kinds.items()
+        }
+
+    @classmethod
+    async def shutdown(cls):
+        if not cls._workers:
+            return
+
+        logging.info("[JobScheduler] Stopping workers")
+        cls._stopping = True
+        for worker in cls._workers:
+            worker.cancel()
+        await asyncio.gather(*cls._workers, return_exceptions=True)
+        cls._workers = []
+        cls._queues = {}
+        cls._stopping = False
+
+    @classmethod
+    async def _worker(cls, kind):
+        queue = cls._queues[kind]
+        while True:
+            _, _, job, fn, args = await queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            cls._running[kind] += 1
+            try:
+                await fn(*args)
+                job.status = "done"
+                cls._counters[kind]["completed"] += 1
+            except asyncio.CancelledError:
+                job.status = "cancelled"
+                # Only the shutdown cancels the worker, a job cancelled from
+                # inside (e.g. a shared future) must not stop the worker
+                if cls._stopping:
+                    raise
+                logging.warning(f"[JobScheduler] {kind} job {job.id} of {job.session_id} was cancelled")
+                cls._counters[kind]["failed"] += 1
+            except Exception as e:
+                logging.error(f"[JobScheduler] {kind} job {job.id} of {job.session_id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+                cls._counters[kind]["failed"] += 1
+            finally:
+                job.finished_at = time.time()
+                cls._running[kind] -= 1
+                queue.task_done()
+
+    @classmethod
+    def _remember(cls, job):
+        cls._forget_expired()
+        cls._jobs.setdefault(job.session_id, deque(maxlen=JOB_HISTORY_SIZE)).append(job)
+
+    @classmethod
+    def _forget_expired(cls):
+        now = time.time()
+        for session_id, jobs in list(cls._jobs.items()):
+            while jobs and jobs[0].finished_at is not None and now - jobs[0].finished_at > SESSION_TTL:
+                jobs.popleft()
+            if not jobs:
+                del cls._jobs[session_id]
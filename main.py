@@ -1,3 +1,7 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from api.upload import router as upload_router  # import your router
@@ -6,12 +10,32 @@ from api.visualize import router as visualize_router
 from api.ask_question_from_rag import router as ask_question_rag_router
 from api.affective_narrative_v2 import router as affective_narrative_router_v2
 from api.affective_narrative_v3 import router as affective_narrative_router_v3
+from api.metrics import router as metrics_router
+from api.jobs import router as jobs_router
+
+
+from ws.websocket import router as websocket_router, websocket_manager
+
+from process_pool_manager import ProcessPoolManager
+from redis_manager import RedisManager
+from job_scheduler import JobScheduler
 
 
-from ws.websocket import router as websocket_router
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared Redis connection pool
+    RedisManager.get_client()
+    JobScheduler.start()
+    yield
+    await JobScheduler.shutdown()
+    await websocket_manager.close()
+    # Stop the stats/plotting workers when the server shuts down, in a thread
+    # so the event loop is not blocked while the running jobs finish
+    await asyncio.to_thread(ProcessPoolManager.shutdown)
+    await RedisManager.close()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # --- Configure CORS middleware on the main app instance ---
 origins = [
@@ -32,4 +56,6 @@ app.include_router(visualize_router, prefix="/api")
 app.include_router(ask_question_rag_router, prefix="/api")
 app.include_router(affective_narrative_router_v2, prefix="/api")
 app.include_router(affective_narrative_router_v3, prefix="/api")
+app.include_router(metrics_router, prefix="/api")
+app.include_router(jobs_router, prefix="/api")
 app.include_router(websocket_router, prefix="/websocket")
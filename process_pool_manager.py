@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+
+class PoolBusyError(Exception):
+    """Raised when the process pool queue is full"""
+
+
+class ProcessPoolManager:
+    """
+    Runs CPU bound work (pandas stats, plotting) in worker processes so the
+    event loop keeps serving websockets and other requests.
+
+    At most max_workers jobs run at once and max_queue more can wait,
+    submit raises PoolBusyError beyond that.
+    """
+    _executor = None
+    _pending = 0
+
+    max_workers = int(os.getenv("PROCESS_POOL_WORKERS", os.cpu_count() or 1))
+    max_queue = int(os.getenv("PROCESS_POOL_QUEUE_SIZE", 8))
+
+    @classmethod
+    def get_executor(cls):
+        if cls._executor is None:
+            logging.info(f"[ProcessPoolManager] Starting {cls.max_workers} workers")
+            # spawn so the workers do not inherit the event loop and client threads
+            cls._executor = ProcessPoolExecutor(
+                max_workers=cls.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return cls._executor
+
+    @classmethod
+    def is_full(cls):
+        return cls._pending >= cls.max_workers + cls.max_queue
+
+    @classmethod
+    def submit(cls, fn, *args) -> asyncio.Future:
+        if cls.is_full():
+            raise PoolBusyError(f"{cls._pending} jobs already running or queued")
+
+        future = asyncio.wrap_future(cls.get_executor().submit(fn, *args))
+        cls._pending += 1
+        future.add_done_callback(cls._job_done)
+        return future
+
+    @classmethod
+    def submit_many(cls, fn, args_list) -> list[asyncio.Future]:
+        """
+        submit_many
+        submit one job per args tuple, all of them or none if they do not fit
+        """
+        if cls._pending + len(args_list) > cls.max_workers + cls.max_queue:
+            raise PoolBusyError(f"{cls._pending} jobs already running or queued, cannot add {len(args_list)}")
+
+        return [cls.submit(fn, *args) for args in args_list]
+
+    @classmethod
+    async def run(cls, fn, *args):
+        return await cls.submit(fn, *args)
+
+    @classmethod
+    def _job_done(cls, _future):
+        cls._pending -= 1
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            logging.info("[ProcessPoolManager] Shutting down workers")
+            cls._executor.shutdown(wait=True, cancel_futures=True)
+            cls._executor = None
@@ -1,18 +1,38 @@
-import redis
+import redis.asyncio as redis
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Sessions expire after 20 minutes by default
+SESSION_TTL = int(os.getenv("SESSION_TTL", 20*60))
+
 class RedisManager:
+    """
+    One async connection pool shared by the whole process, opened on startup
+    and closed on shutdown by the app lifespan
+    """
+    _pool = None
     _client = None
 
+    max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
+
     @classmethod
     def get_client(cls):
         if cls._client is None:
-            cls._client = redis.Redis(
+            cls._pool = redis.ConnectionPool(
                 host=os.getenv("REDIS_HOST", "host.docker.internal"),
                 port=int(os.getenv("REDIS_PORT", 6379)),
+                max_connections=cls.max_connections,
                 decode_responses=True
             )
+            cls._client = redis.Redis(connection_pool=cls._pool)
         return cls._client
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            await cls._pool.aclose()
+            cls._client = None
+            cls._pool = None
@@ -0,0 +1,150 @@
+"""
+Rows appended to an uploaded dataset
+
+The aggregates saved with the stats (stat_state.npz, see
+services/stream_stat.py) are loaded and only the new rows are folded in:
+count, sum, sum of squares, min and max per day and field, and the
+co-moments of the numeric fields. stat.json is written again from the
+aggregates, so the cost depends on the new rows and the number of days, not
+on the number of rows already uploaded.
+
+The new rows are appended to data.csv and written to a new Arrow part. The
+dataset hash is chained with the hash of the new rows and only the columns
+that got new values get a new graph hash (see services/graph_cache.py).
+"""
+
+import hashlib
+import logging
+import os
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from services.stream_stat import STAT_CHUNK_SIZE, STAT_STATE_FILE_NAME, StatAccumulator
+from services.correlation import CORRELATION_METHOD, correlation_matrix, sparse_correlation
+from services.columnar import ColumnarWriter, next_columnar_part, read_columns
+from services.graph_cache import HASH_CHUNK_SIZE, chain_hash, get_column_hashes, get_dataset_hash, save_column_hashes, save_dataset_hash
+from services.stat_store import STAT_FILE_NAME, write_stat
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_header_line(path):
+    with open(path, "rb") as f:
+        return f.readline().rstrip(b"\r\n")
+
+
+def append_descriptive_stats(session_dir, append_file_path, session_id: str = None, chunksize: int = STAT_CHUNK_SIZE):
+    """
+    append_descriptive_stats
+    fold the rows of append_file_path into the stats of the session and
+    append them to the dataset, raise ValueError when the columns differ
+    return the number of rows, the years and the columns that changed
+    """
+    session_dir = Path(session_dir)
+    append_file_path = Path(append_file_path)
+    csv_file_path = session_dir/"data.csv"
+    state_path = session_dir/STAT_STATE_FILE_NAME
+
+    accumulator = StatAccumulator.load(state_path, session_id)
+    header = pd.read_csv(append_file_path, nrows=0).columns.tolist()
+    if sorted(header) != sorted(accumulator.columns):
+        raise ValueError(f"The columns {header} do not match the columns of the dataset {accumulator.columns}")
+
+    same_layout = read_header_line(append_file_path) == read_header_line(csv_file_path)
+    rows_path = append_file_path if same_layout else append_file_path.with_name(f"{append_file_path.name}.rows")
+
+    rows = 0
+    years = set()
+    changed = set()
+    writer = ColumnarWriter(next_columnar_part(session_dir))
+    try:
+        if not same_layout:
+            _reorder_rows(append_file_path, rows_path, accumulator.columns, chunksize)
+
+        with pd.read_csv(append_file_path, chunksize=chunksize) as reader:
+            for chunk in reader:
+                chunk = chunk[accumulator.columns]
+                rows += len(chunk)
+                changed.update(
+                    column for column in accumulator.columns
+                    if column != accumulator.date_field and chunk[column].notna().any()
+                )
+                accumulator.add_chunk(chunk)
+                years.update(chunk[accumulator.date_field].dt.year.dropna().astype(int).tolist())
+                writer.write(chunk)
+
+        if rows == 0:
+            writer.abort()
+            return {"rows": 0, "years": [], "columns": []}
+
+        # Read before data.csv changes, the stored hashes would look outdated after
+        dataset_hash = get_dataset_hash(session_dir)
+        column_hashes = get_column_hashes(session_dir, accumulator.columns, dataset_hash)
+        rows_hash = _append_rows(csv_file_path, rows_path, skip_header=same_layout)
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        if not same_layout:
+            rows_path.unlink(missing_ok=True)
+
+    # Closed after data.csv was written, the columnar copy stays up to date
+    writer.close()
+    save_dataset_hash(session_dir, chain_hash(dataset_hash, rows_hash))
+    save_column_hashes(session_dir, {
+        column: chain_hash(column_hash, rows_hash) if column in changed else column_hash
+        for column, column_hash in column_hashes.items()
+    })
+
+    stat = accumulator.to_stat()
+    if CORRELATION_METHOD == "spearman":
+        # Ranks are not mergeable, they are computed again over the whole
+        # dataset, or over the sample of the rows when the stats are approximate
+        fields = accumulator.numeric_fields()
+        if accumulator.approximate:
+            stat["data"]["correlation"] = accumulator.get_sample_correlation()
+        elif (df := read_columns(session_dir, fields)) is None:
+            logging.warning("[append_descriptive_stats] Spearman needs the columnar file, using Pearson")
+        else:
+            values = df.to_numpy(dtype=float, na_value=np.nan)
+            stat["data"]["correlation"] = sparse_correlation(fields, correlation_matrix(values, "spearman"))
+
+    write_stat(session_dir/STAT_FILE_NAME, stat)
+    accumulator.save(state_path)
+
+    logging.info(f"[append_descriptive_stats] Appended {rows} rows, years {sorted(years)}")
+    return {
+        "rows": rows,
+        "years": sorted(years),
+        "columns": [column for column in accumulator.columns if column in changed],
+    }
+
+
+def _reorder_rows(append_file_path, rows_path, columns, chunksize):
+    # Rows in another column order are written again in the order of data.csv,
+    # from the raw strings so the values are the ones that were uploaded
+    with pd.read_csv(append_file_path, dtype=str, keep_default_na=False, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk[columns].to_csv(rows_path, mode="a", header=False, index=False)
+
+
+def _append_rows(csv_file_path, rows_path, skip_header):
+    # Byte copy of the new rows, return their sha256
+    sha256 = hashlib.sha256()
+    with open(csv_file_path, "rb+") as f, open(rows_path, "rb") as rows_file:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+        if skip_header:
+            rows_file.readline()
+        while content := rows_file.read(HASH_CHUNK_SIZE):
+            f.write(content)
+            sha256.update(content)
+
+    return sha256.hexdigest()
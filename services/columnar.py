@@ -0,0 +1,183 @@
+"""
+Columnar copy of the session dataset
+
+The upload is converted once, while the stats are computed, into
+uploaded_files/<session_id>/data.arrow: an uncompressed Arrow IPC file with
+typed columns and the date column already parsed. Readers memory-map it and
+only the pages of the selected columns are read, instead of parsing the
+whole CSV text again. Appended rows go to data.part-<n>.arrow files that are
+read after data.arrow. The files are only used when they are newer than
+data.csv.
+"""
+
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.types as pat
+
+logging.basicConfig(level=logging.INFO)
+
+COLUMNAR_FILE_NAME = "data.arrow"
+COLUMNAR_PART_PATTERN = "data.part-*.arrow"
+
+
+def unify_type(current, new):
+    """
+    unify_type
+    return the arrow type holding the values of both types
+    """
+    if current == new or pat.is_null(new):
+        return current
+    if pat.is_null(current):
+        return new
+
+    both_numeric = (
+        (pat.is_integer(current) or pat.is_floating(current))
+        and (pat.is_integer(new) or pat.is_floating(new))
+    )
+    if both_numeric:
+        return pa.float64()
+
+    return pa.large_string()
+
+
+class ColumnarWriter:
+    """
+    Writes the chunks of a dataset to one Arrow IPC file
+
+    The schema is the one of the first chunk. When a later chunk needs a
+    wider type (int then float, numbers then text) the batches written so
+    far are converted to the unified schema once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.schema = None
+        self._sink = None
+        self._writer = None
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+
+        if self._writer is None:
+            self._open(table.schema)
+        elif table.schema != self.schema:
+            unified = pa.schema([
+                field.with_type(unify_type(field.type, table.schema.field(field.name).type))
+                for field in self.schema
+            ])
+            if unified != self.schema:
+                self._rewrite(unified)
+            table = table.cast(self.schema)
+
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        self._sink.close()
+        os.replace(self.tmp_path, self.path)
+        self._writer = None
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def _open(self, schema):
+        # No pandas metadata, the schema changes when a type is widened
+        self.schema = schema.remove_metadata()
+        self._sink = pa.OSFile(self.tmp_path, "wb")
+        self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def _rewrite(self, schema):
+        logging.info(f"[ColumnarWriter] Widening the schema of {self.path}")
+        self._writer.close()
+        self._sink.close()
+
+        old_path = f"{self.tmp_path}.old"
+        os.replace(self.tmp_path, old_path)
+        self._open(schema)
+        with pa.memory_map(old_path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                self._writer.write_table(pa.Table.from_batches([reader.get_batch(i)]).cast(schema))
+        os.remove(old_path)
+
+
+def columnar_path(session_dir):
+    return session_dir/COLUMNAR_FILE_NAME
+
+
+def columnar_parts(session_dir):
+    """
+    columnar_parts
+    return the Arrow files of the appended rows, in the order they were appended
+    """
+    return sorted(session_dir.glob(COLUMNAR_PART_PATTERN), key=lambda path: int(path.stem.split("-")[-1]))
+
+
+def next_columnar_part(session_dir):
+    parts = columnar_parts(session_dir)
+    index = int(parts[-1].stem.split("-")[-1]) + 1 if parts else 0
+    return session_dir/f"data.part-{index}.arrow"
+
+
+def clear_columnar_parts(session_dir):
+    for path in columnar_parts(session_dir):
+        path.unlink(missing_ok=True)
+
+
+def has_columnar(session_dir):
+    path = columnar_path(session_dir)
+    csv_path = session_dir/"data.csv"
+    if not path.exists():
+        return False
+    if not csv_path.exists():
+        return True
+
+    # After an append data.csv is newer than data.arrow, the last part is not
+    newest = max(part.stat().st_mtime for part in [path, *columnar_parts(session_dir)])
+    return newest >= csv_path.stat().st_mtime
+
+
+def read_columns(session_dir, columns=None):
+    """
+    read_columns
+    return the selected columns of the dataset as a DataFrame, read from the
+    memory-mapped Arrow files, None when there is no up to date Arrow file
+    """
+    if not has_columnar(session_dir):
+        return None
+
+    parts = columnar_parts(session_dir)
+    if not parts:
+        return read_columnar_file(columnar_path(session_dir), columns)
+
+    tables = [_read_table(path, columns) for path in [columnar_path(session_dir), *parts]]
+    schema = tables[0].schema
+    for table in tables[1:]:
+        schema = pa.schema([
+            field.with_type(unify_type(field.type, table.schema.field(field.name).type))
+            for field in schema
+        ])
+    return pa.concat_tables([table.cast(schema) for table in tables]).to_pandas()
+
+
+def read_columnar_file(path, columns=None):
+    return _read_table(path, columns).to_pandas()
+
+
+def _read_table(path, columns=None):
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(list(columns))
+        return table
@@ -0,0 +1,108 @@
+"""
+Correlation of the numeric fields
+
+The matrix is computed with float32 matrix products over the
+pairwise-complete observations (same result as DataFrame.corr, without the
+per pair loop). Only the strongest pairs of each field are kept:
+CORRELATION_TOP_K pairs per field whose absolute value is at least
+CORRELATION_MIN_ABS. Every numeric field stays a key of the output, the
+narratives take their field list from it.
+
+CORRELATION_METHOD is pearson or spearman. Spearman ranks each column over
+its own values, it matches DataFrame.corr(method="spearman") when there are
+no missing values.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+
+CORRELATION_METHODS = ["pearson", "spearman"]
+CORRELATION_METHOD = os.getenv("CORRELATION_METHOD", "pearson")
+CORRELATION_TOP_K = int(os.getenv("CORRELATION_TOP_K", 10))
+CORRELATION_MIN_ABS = float(os.getenv("CORRELATION_MIN_ABS", 0.0))
+
+
+def correlation_matrix(values: np.ndarray, method=CORRELATION_METHOD):
+    """
+    correlation_matrix
+    return the p x p correlation of the columns of values (rows x p, NaN
+    for the missing values), NaN when a pair has no variance
+    """
+    if method not in CORRELATION_METHODS:
+        raise ValueError(f"Unknown correlation method {method}, expected one of {CORRELATION_METHODS}")
+
+    if method == "spearman":
+        values = pd.DataFrame(values).rank().to_numpy()
+
+    valid = ~np.isnan(values)
+    # Centered first so float32 keeps the precision
+    with np.errstate(invalid="ignore"):
+        center = np.nanmean(values, axis=0) if valid.any() else np.zeros(values.shape[1])
+    x = np.where(valid, values - np.nan_to_num(center), 0.0).astype(np.float32)
+
+    if valid.all():
+        n = np.float32(len(values))
+        sx = x.sum(axis=0)
+        cov = x.T @ x - np.outer(sx, sx) / n
+        var = np.diag(cov)
+        return moments_to_correlation(cov, var[:, None], var[None, :])
+
+    mask = valid.astype(np.float32)
+    n = mask.T @ mask
+    sx = x.T @ mask
+    sxx = (x * x).T @ mask
+    sxy = x.T @ x
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sxy - sx * sx.T / n
+        var_x = sxx - sx * sx / n
+    return moments_to_correlation(cov, var_x, var_x.T, n)
+
+
+def moments_to_correlation(cov, var_x, var_y, n=None):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        divisor = np.sqrt(var_x * var_y)
+        valid = divisor > 0
+        if n is not None:
+            valid &= n > 1
+        cor = np.where(valid, cov / divisor, np.nan)
+    return np.clip(cor, -1, 1)
+
+
+def sparse_correlation(fields, cor, top_k=CORRELATION_TOP_K, min_abs=CORRELATION_MIN_ABS):
+    """
+    sparse_correlation
+    return {field: {other field: correlation}} with the top_k strongest
+    pairs of each field above min_abs, in the column order
+    """
+    cor = np.round(np.asarray(cor, dtype=np.float64), 2)
+    strength = np.abs(cor)
+    np.fill_diagonal(strength, np.nan)
+    strength = np.where(np.isnan(strength) | (strength < min_abs), -1.0, strength)
+
+    # Rank of every pair within its row, strongest first
+    order = np.argsort(-strength, axis=1, kind="stable")
+    keep = np.zeros_like(strength, dtype=bool)
+    np.put_along_axis(keep, order[:, :top_k], True, axis=1)
+    keep &= strength >= 0
+
+    correlation = {}
+    for i, field in enumerate(fields):
+        columns = np.flatnonzero(keep[i])
+        correlation[field] = dict(zip((fields[j] for j in columns), cor[i, columns].tolist()))
+
+    return correlation
+
+
+def get_correlation(df: pd.DataFrame, method=CORRELATION_METHOD, top_k=CORRELATION_TOP_K, min_abs=CORRELATION_MIN_ABS):
+    """
+    get_correlation
+    return the sparse correlation of the numeric fields of df
+    """
+    fields = [field for field, field_type in df.dtypes.items() if pd.api.types.is_numeric_dtype(field_type)]
+    values = df[fields].to_numpy(dtype=float, na_value=np.nan)
+    return sparse_correlation(fields, correlation_matrix(values, method), top_k, min_abs)
@@ -0,0 +1,46 @@
+import logging
+
+from pathlib import Path
+
+from util.date import parse_date_column
+
+logging.basicConfig(level=logging.INFO)
+UPLOAD_ROOT = Path("uploaded_files")
+
+# The detected date format is kept in a file of the session folder, read on
+# every call (no process-local copy) so that every worker process sees the
+# format of the current upload
+
+
+def get_session_date_format(session_id):
+    format_file_path = UPLOAD_ROOT/session_id/"date_format.txt"
+    try:
+        return format_file_path.read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def save_session_date_format(session_id, date_format):
+    session_dir = UPLOAD_ROOT/session_id
+    session_dir.mkdir(parents=True, exist_ok=True)
+    (session_dir/"date_format.txt").write_text(date_format or "")
+
+
+def clear_session_date_format(session_id):
+    (UPLOAD_ROOT/session_id/"date_format.txt").unlink(missing_ok=True)
+
+
+def parse_session_dates(session_id, values):
+    """
+    parse_session_dates
+    parse the date column with the format detected for the session,
+    the format is detected once and reused by every later call
+    """
+    date_format = get_session_date_format(session_id)
+    parsed, used_format = parse_date_column(values, date_format)
+
+    if used_format is not None and used_format != date_format:
+        logging.info(f"[parse_session_dates] Detected date format {used_format} for session {session_id}")
+        save_session_date_format(session_id, used_format)
+
+    return parsed
@@ -0,0 +1,169 @@
+"""
+Persistent embedding cache
+
+Embeddings are stored in SQLite keyed by (model name, sha256 of the text),
+so identical chunks are embedded once across sessions and restarts. The
+least recently used entries are evicted when the store grows over
+EMBEDDING_CACHE_MAX_BYTES.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from array import array
+from pathlib import Path
+
+from langchain_core.embeddings import Embeddings
+
+logging.basicConfig(level=logging.INFO)
+
+EMBEDDING_CACHE_PATH = Path(os.getenv("EMBEDDING_CACHE_PATH", "uploaded_files/embedding_cache.sqlite3"))
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 256 * 1024 * 1024))  # 256 MB
+
+
+def text_hash(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, "
+                "text_hash TEXT NOT NULL, "
+                "embedding BLOB NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        return self._conn
+
+    def get_many(self, model: str, texts: list[str]):
+        """
+        get_many
+        return the cached embedding of each text, None for the misses
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            conn = self._get_conn()
+            unique_hashes = list(set(hashes))
+            # Stay under the SQLite limit of bound parameters
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                )
+                for row_hash, blob in rows:
+                    found[row_hash] = array("d", blob).tolist()
+
+            if found:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(time.time(), model, row_hash) for row_hash in found],
+                )
+                conn.commit()
+
+            embeddings = [found.get(h) for h in hashes]
+            hit_count = sum(embedding is not None for embedding in embeddings)
+            self.hits += hit_count
+            self.misses += len(embeddings) - hit_count
+
+        return embeddings
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]]):
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array("d", embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            conn = self._get_conn()
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            conn.commit()
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop the least recently used entries until the store fits
+        evicted = 0
+        for rowid, size in conn.execute("SELECT rowid, LENGTH(embedding) FROM embeddings ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM embeddings WHERE rowid = ?", (rowid,))
+            total -= size
+            evicted += 1
+        conn.commit()
+        logging.info(f"[EmbeddingCache] Evicted {evicted} embeddings")
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._get_conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+embedding_cache = EmbeddingCache()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends the texts missing from the cache to the model
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: EmbeddingCache = embedding_cache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        embeddings = self.cache.get_many(self.model, texts)
+        missing_texts = list(dict.fromkeys(
+            text for text, embedding in zip(texts, embeddings) if embedding is None
+        ))
+        if missing_texts:
+            new_embeddings = self.embeddings.embed_documents(missing_texts)
+            self.cache.put_many(self.model, missing_texts, new_embeddings)
+            computed = dict(zip(missing_texts, new_embeddings))
+            embeddings = [
+                embedding if embedding is not None else computed[text]
+                for text, embedding in zip(texts, embeddings)
+            ]
+
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        embedding = self.cache.get_many(self.model, [text])[0]
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model, [text], [embedding])
+
+        return embedding
@@ -1,7 +1,8 @@
-import pandas as pd
+import numpy as np
 import logging
 
-from util.date import get_date
+from services.period_summary import format_values
+from services.sketch import STAT_PERCENTILES, percentile_name
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,126 +17,36 @@ def get_date_field(fields):
             return field_name
         
 
-def get_correlation(df):
-    """
-    get_correlation
-    return the correlation
-    """
-    correlation = {}
-    cor = df.corr(method="pearson", numeric_only=True)
-
-    all_fields = cor.index
-    for field in cor:
-        correlation[field] = {}
-        for other_fields in all_fields:
-            if field == other_fields:
-                continue
-            correlation[field][other_fields] = round(cor[field].loc[other_fields], 2)
-
-    return correlation
-
-def get_summary_by_year(df, date_field):
-    all_types = df.dtypes
-    field_names = all_types.index
-    numerical_fields = []
-
-    logging.info("All Typses: %s", all_types)
-    logging.info("Shape of DataFrame: %s", df.shape[1])
-
-    # Ensure 'date' column is in datetime format
-    df[date_field] = pd.to_datetime(df[date_field])
-    for i in range(df.shape[1]):
-        field_type = str(all_types.iloc[i])
-        if pd.api.types.is_numeric_dtype(field_type):
-            numerical_fields.append(field_names[i])
-
-    # Create 'year' column for grouping
-    df['year'] = df[date_field].dt.year
-
-    # Group by year, then aggregate
-    summary_df = df.groupby(['year'])[numerical_fields].agg(['mean', 'max', 'min', 'std'])
-    summary_df.columns = ['_'.join(col).strip() for col in summary_df.columns.values]
-    summary_df = summary_df.reset_index()
-
-    summary_by_year = []
-    for _, row in summary_df.iterrows():
-        entry = {
-            "year": int(row["year"]),
-            "metrics": {}
-        }
-
-        
-        for field in numerical_fields:
-            mean_value = row[f"{field}_mean"]
-            max_value = row[f"{field}_max"]
-            min_value = row[f"{field}_min"]
-            std_value = row[f"{field}_std"]
-
-            entry["metrics"][field] = {
-                "mean": str(round(mean_value, 2)) if pd.notnull(mean_value) else 0,
-                "max": str(round(max_value, 2)) if pd.notnull(max_value) else 0,
-                "min": str(round(min_value, 2)) if pd.notnull(min_value) else 0,
-                "std": str(round(mean_value, 2)) if pd.notnull(std_value) else 0
-            }
-
-        summary_by_year.append(entry)
-
-
-    return summary_by_year
-
-
-
-def generate_descriptive_stats(df: pd.DataFrame):
-    """
-    generate_descriptive_stats
-    return fields, descriptive stat, and correlation
-    """
-
-    """
-    Fields
-    """
-    fields = {}
-    fields_type = df.dtypes
-    fields_name = fields_type.index
-    num_total_fields = len(fields_name)
-    logging.info("Field Type: %s", fields_type)
-
-    for i in range (0, num_total_fields):
-        fields[fields_name[i]] = str(fields_type.iloc[i])
-    
-    """
-    Start and End
-    """
-    date = {}
-    date_field = get_date_field(fields)
-    df["date_with_format"] = df[date_field].map(lambda x: get_date(x))
-
-    start_date = min(df["date_with_format"])
-    end_date = max(df["date_with_format"])
-
-    date["start_date"] = str(start_date)
-    date["end_date"] = str(end_date)
-
-    """
-    Correlation
-    """
-    cor = get_correlation(df)
-
-    """
-    Group By
-    """
-    by_year = get_summary_by_year(df, date_field)
-
-
-    """
-    Format final data
-    """
-    data = {}
-    data["fields"] = fields
-    data["date"] = date
-    data["correlation"] = cor
-    data["summary_by_year"] = by_year
-    
-    final = {"data": data}
-
-    return final
\ No newline at end of file
+def format_stat(fields, mean, minimum, maximum, sd, percentiles):
+    """
+    format_stat
+    return the whole period metrics of the fields (the stat key of
+    stat.json), percentiles is a fields x STAT_PERCENTILES array
+    """
+    metrics = {
+        "mean": format_values(mean),
+        "min": format_values(minimum),
+        "max": format_values(maximum),
+        "sd": format_values(sd),
+    }
+    for j, percentile in enumerate(STAT_PERCENTILES):
+        metrics[percentile_name(percentile)] = format_values(percentiles[:, j])
+
+    return {
+        field: {name: values[i] for name, values in metrics.items()}
+        for i, field in enumerate(fields)
+    }
+
+def add_year_percentiles(summary_by_year, fields, percentiles_by_year):
+    """
+    add_year_percentiles
+    add the median and percentiles to the metrics of every year,
+    percentiles_by_year is {year: fields x STAT_PERCENTILES array}
+    """
+    missing = np.full((len(fields), len(STAT_PERCENTILES)), np.nan)
+    for yearly_stat in summary_by_year:
+        percentiles = format_values(percentiles_by_year.get(yearly_stat["year"], missing))
+        for i, field in enumerate(fields):
+            yearly_stat["metrics"][field].update({
+                percentile_name(percentile): percentiles[i, j] for j, percentile in enumerate(STAT_PERCENTILES)
+            })
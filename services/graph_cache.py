@@ -0,0 +1,144 @@
+"""
+Content addressed cache of the rendered graphs
+
+A graph is stored once under uploaded_files/.graph_cache/<key>.png where the
+key is the hash of (dataset hash, column, color, size, dpi). Sessions get a
+hard link to the cached file, so repeated visualization requests and
+narrative runs only cost a lookup. The cache is kept under a disk budget by
+evicting the least recently used files (mtime is touched on every hit).
+
+After rows are appended only the columns that got new values change, their
+hash is chained with the hash of the new rows in columns.sha256.json; the
+other columns keep their hash, so their graphs are still served from the cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO)
+
+GRAPH_CACHE_DIR = Path(os.getenv("GRAPH_CACHE_DIR", "uploaded_files/.graph_cache"))
+GRAPH_CACHE_MAX_BYTES = int(os.getenv("GRAPH_CACHE_MAX_BYTES", 1024 * 1024 * 1024))  # 1 GB
+
+# Bump when the plotting code changes so old graphs are not served
+GRAPH_RENDER_VERSION = 2
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+COLUMN_HASH_FILE_NAME = "columns.sha256.json"
+
+
+def save_dataset_hash(session_dir, dataset_hash):
+    (session_dir/"data.sha256").write_text(dataset_hash)
+
+
+def get_dataset_hash(session_dir):
+    """
+    get_dataset_hash
+    return the sha256 of data.csv, computed on upload or lazily when missing
+    """
+    data_path = session_dir/"data.csv"
+    hash_path = session_dir/"data.sha256"
+    if hash_path.exists() and hash_path.stat().st_mtime >= data_path.stat().st_mtime:
+        return hash_path.read_text().strip()
+
+    sha256 = hashlib.sha256()
+    with open(data_path, "rb") as f:
+        while content := f.read(HASH_CHUNK_SIZE):
+            sha256.update(content)
+
+    dataset_hash = sha256.hexdigest()
+    save_dataset_hash(session_dir, dataset_hash)
+    return dataset_hash
+
+
+def chain_hash(previous_hash, content_hash):
+    return hashlib.sha256(f"{previous_hash}:{content_hash}".encode()).hexdigest()
+
+
+def save_column_hashes(session_dir, column_hashes):
+    (session_dir/COLUMN_HASH_FILE_NAME).write_text(json.dumps(column_hashes))
+
+
+def clear_column_hashes(session_dir):
+    (session_dir/COLUMN_HASH_FILE_NAME).unlink(missing_ok=True)
+
+
+def get_column_hashes(session_dir, columns, dataset_hash=None):
+    """
+    get_column_hashes
+    return {column: hash of the data behind its graph}, the dataset hash for
+    the columns that did not change since the upload
+    """
+    path = session_dir/COLUMN_HASH_FILE_NAME
+    column_hashes = json.loads(path.read_text()) if path.exists() else {}
+    if dataset_hash is None and any(column not in column_hashes for column in columns):
+        dataset_hash = get_dataset_hash(session_dir)
+    return {column: column_hashes.get(column, dataset_hash) for column in columns}
+
+
+def graph_cache_key(dataset_hash, column, color, figsize, dpi, downsample_method=None):
+    key = json.dumps([GRAPH_RENDER_VERSION, dataset_hash, column, color, list(figsize), dpi, downsample_method])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def lookup_graph(key, output_path):
+    """
+    lookup_graph
+    link the cached graph to output_path, return False on a cache miss
+    """
+    cache_path = GRAPH_CACHE_DIR/f"{key}.png"
+    try:
+        os.utime(cache_path)  # mark as recently used
+    except FileNotFoundError:
+        return False
+
+    _link(cache_path, output_path)
+    return True
+
+
+def store_graph(key, graph_path):
+    GRAPH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path = GRAPH_CACHE_DIR/f"{key}.png"
+    _link(graph_path, cache_path)
+
+
+def evict_graphs(max_bytes=GRAPH_CACHE_MAX_BYTES):
+    """
+    evict_graphs
+    remove the least recently used graphs until the cache fits in max_bytes
+    """
+    if not GRAPH_CACHE_DIR.exists():
+        return
+
+    entries = []
+    for entry in os.scandir(GRAPH_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".png"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        Path(path).unlink(missing_ok=True)
+        total -= size
+        logging.info(f"[evict_graphs] Evicted {path}")
+
+
+def _link(source, target):
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+
+    # Replace the target instead of writing into it, it may be a link to a cached graph
+    tmp_path = Path(f"{target}.{uuid.uuid4().hex}.tmp")
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
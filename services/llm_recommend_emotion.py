@@ -2,11 +2,15 @@ import json
 import logging
 import time
 import os
+import re
+import hashlib
 
 from pathlib import Path
 from pydantic import BaseModel, Field
 
 from ws.websocket import websocket_manager
+from redis_manager import RedisManager
+from services.stat_store import load_stat
 
 from langchain_core.prompts import PromptTemplate 
 from langchain_core.output_parsers import JsonOutputParser
@@ -54,6 +58,42 @@ model = ChatOpenAI(
     max_retries=2,
 )
 
+# Cached recommendations expire after 24 hours by default
+EMOTION_CACHE_TTL = int(os.getenv("EMOTION_CACHE_TTL", 24*60*60))
+
+def normalize_text(text: str):
+    return re.sub(r"\s+", " ", text or "").strip().casefold()
+
+def emotion_cache_key(description: str, field_summary: str):
+    """
+    emotion_cache_key
+    return the cache key of a recommendation, every input of the two chains is part of it
+    """
+    signature = json.dumps({
+        "description": normalize_text(description),
+        "field_summary": normalize_text(field_summary),
+        "positive_emotions": positive_emotions,
+        "negative_emotions": negative_emotions,
+        "model": model.model_name,
+    }, sort_keys=True)
+
+    return f"emotion_cache:{hashlib.sha256(signature.encode()).hexdigest()}"
+
+async def get_cached_emotion(cache_key: str):
+    try:
+        res = await RedisManager.get_client().get(cache_key)
+    except Exception as e:
+        logging.warning(f"[get_cached_emotion] Cannot read the cache: {e}")
+        return None
+
+    return json.loads(res) if res is not None else None
+
+async def set_cached_emotion(cache_key: str, res):
+    try:
+        await RedisManager.get_client().set(cache_key, json.dumps(res), ex=EMOTION_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"[set_cached_emotion] Cannot write the cache: {e}")
+
 # Define your desired data structure.
 class EmotionRecommendation(BaseModel):
     emotion: str = Field(description="the recommended emotion for the data narrative")
@@ -120,11 +160,10 @@ def inappropriate_emotion_chain_generator():
 def field_name_summary(session_id: str):
     session_dir = UPLOAD_ROOT/session_id
     stat_file_path = session_dir / "stat.json"
-    with open(stat_file_path) as json_data:
-        stat = json.load(json_data)
-        field_description = "The dataset contains the columns: "
-        for field_name in stat['data']['fields']:
-            field_description = field_description + " " + field_name
+    stat = load_stat(stat_file_path)
+    field_description = "The dataset contains the columns: "
+    for field_name in stat['data']['fields']:
+        field_description = field_description + " " + field_name
     
     field_description = field_description + ". "
     logging.info(f"Field description: {field_description}")
@@ -135,6 +174,17 @@ async def llm_emotion_recommendation(session_id: str, description: str):
     logging.info("Starting emotion recommendation process...")
     field_summary = field_name_summary(session_id)
 
+    cache_key = emotion_cache_key(description, field_summary)
+    res = await get_cached_emotion(cache_key)
+    if res is not None:
+        logging.info("Emotion recommendation found in the cache, skipping the LLM calls")
+    else:
+        res = await run_emotion_recommendation(description, field_summary)
+        await set_cached_emotion(cache_key, res)
+
+    await send_emotion_recommendation(session_id, res)
+
+async def run_emotion_recommendation(description: str, field_summary: str):
     recommended_emotion_chain = recommended_emotion_chain_generator()
     inappropriate_emotion_chain = inappropriate_emotion_chain_generator()
 
@@ -171,6 +221,9 @@ async def llm_emotion_recommendation(session_id: str, description: str):
             logging.error(f"An unexpected error occurred: {e}")
             raise
 
+    return res
+
+async def send_emotion_recommendation(session_id: str, res):
     if "properties" in res['recommend_emotion']:
         recommended_emotion_result = res['recommend_emotion']["properties"]
     else:
@@ -1,4 +1,4 @@
-import json
+import asyncio
 import logging
 import os
 
@@ -6,18 +6,23 @@ from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_ollama import OllamaLLM
 from pydantic import BaseModel
-from ws.websocket import websocket_manager
+from services.narrative_stream import send_narrative
+from services.narrative_cache import cached_narrative, file_hash, narrative_cache_key
 from langchain_openai import ChatOpenAI
 
 from services.stat_q_a import data_change_through_out_year
 
-from services.redis_util import get_description_from_redis
-from services.redis_util import get_core_concept
+from services.redis_util import get_session_state
+from services.stat_store import load_stat
 
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 UPLOAD_ROOT = Path("uploaded_files")
+
+# Bump when the prompt or the model changes so cached narratives are not served
+NARRATIVE_PIPELINE_VERSION = "v2.1"
+
 # model = OllamaLLM(
 #     model="llama3.1:8b",
 #     base_url="http://host.docker.internal:11434" 
@@ -63,40 +68,37 @@ class Agency(BaseModel):
     intensity_level: int
     word_count: int
     purpose: str
+    stream: bool = False
 
 # Summarize story by Q and A, without having to summarize story for each field first
-async def llm_summarize_story_v2(session_id: str, agency: Agency):
+async def llm_summarize_story_v2(session_id: str, agency: Agency, core_concept: str = None):
     session_dir = UPLOAD_ROOT/session_id
     stat_file_path = session_dir / "stat.json"
 
-    core_concept = get_core_concept(session_id)
-    if not isinstance(core_concept, str):
-        core_concept = get_description_from_redis(session_id)
+    if core_concept is None:
+        state = await get_session_state(session_id, "core_concept", "description")
+        core_concept = state["core_concept"] or state["description"]
+
+    stat_hash = await asyncio.to_thread(file_hash, stat_file_path)
+    cache_key = narrative_cache_key(NARRATIVE_PIPELINE_VERSION, stat_hash, core_concept, agency)
 
-    with open(stat_file_path) as json_data:
-        stat = json.load(json_data)
+    async def generate():
+        stat = load_stat(stat_file_path)
         fields = [field for field in stat["data"]["correlation"]]
         summarize_data = []
         for field in fields:
             summarize_data.append(data_change_through_out_year(stat["data"]["summary_by_year"], field))
-        
+
         logging.info(f"Summarize data: {summarize_data}")
 
         data_story_chain = data_story_chain_generator_v2()
-        data_story_result = await data_story_chain.ainvoke({
+        return await send_narrative(session_id, data_story_chain, {
             "core_concept": core_concept,
             "q_and_a": summarize_data,
             "emotion": agency.emotion,
             "intensity_level": agency.intensity_level,
             "word_count": agency.word_count,
             "purpose": agency.purpose
-        })
-
-        logging.info(f"Data Story Result: {data_story_result}")
+        }, stream=agency.stream)
 
-        await websocket_manager.send_message(session_id, json.dumps({
-            "data": {
-                "title": "affective_narrative",
-                "result": data_story_result
-            }
-        }))
+    return await cached_narrative(session_id, cache_key, generate)
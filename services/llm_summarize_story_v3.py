@@ -1,7 +1,8 @@
-import json
+import asyncio
 import logging
 import os
 import base64
+import time
 
 from pathlib import Path
 
@@ -10,11 +11,19 @@ from pydantic import BaseModel
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
-from ws.websocket import websocket_manager
+from services.narrative_stream import send_narrative
+from services.stat_store import load_stat
+from services.narrative_cache import cached_narrative, file_hash, files_hash, narrative_cache_key
 
 logging.basicConfig(level=logging.INFO)
 UPLOAD_ROOT = Path("uploaded_files")
 
+# Bump when the prompts or the model change so cached narratives are not served
+NARRATIVE_PIPELINE_VERSION = "v3.1"
+
+# Number of fields summarized by the LLM at the same time
+FIELD_SUMMARY_CONCURRENCY = int(os.getenv("FIELD_SUMMARY_CONCURRENCY", 4))
+
 os.environ.get("OPENAI_API_KEY")
 
 model = ChatOpenAI(
@@ -25,28 +34,25 @@ model = ChatOpenAI(
     max_retries=2,
 )
 
-def summarize_the_story_of_each_field(session_id: str, field, description):
+async def summarize_the_story_of_each_field(session_id: str, field, description, stat):
     session_dir = UPLOAD_ROOT/session_id
-    stat_file_path = session_dir / "stat.json"
     focus_summary = []
 
-    with open(stat_file_path) as json_data:
-        stat = json.load(json_data)
-        yearly_summarize =  stat["data"]["summary_by_year"]
-        for year in yearly_summarize:
-            field_summary = year["metrics"][field]
-            new_summary = {
-                "year": year["year"],
-                "value": field_summary
-            }
+    yearly_summarize =  stat["data"]["summary_by_year"]
+    for year in yearly_summarize:
+        field_summary = year["metrics"][field]
+        new_summary = {
+            "year": year["year"],
+            "value": field_summary
+        }
 
-            focus_summary.append(new_summary)
+        focus_summary.append(new_summary)
 
     graph_file_path = session_dir/"graph"/f"{field}.png"
-    image_data = encode_image(graph_file_path)
+    image_data = await asyncio.to_thread(encode_image, graph_file_path)
 
     field_summary_generator = data_story_chain_generator_with_image()
-    field_summary = field_summary_generator.invoke({
+    field_summary = await field_summary_generator.ainvoke({
         "description": description,
         "stat_summary": focus_summary,
         "image_data": image_data
@@ -60,6 +66,32 @@ def summarize_the_story_of_each_field(session_id: str, field, description):
     return field_summary
 
 
+async def summarize_all_fields(session_id: str, fields, description, stat, concurrency=FIELD_SUMMARY_CONCURRENCY):
+    """
+    summarize_all_fields
+    summarize the fields concurrently, at most `concurrency` LLM calls at a time
+    return the summaries in the order of the fields and the time taken by each field
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def summarize(field):
+        async with semaphore:
+            start = time.monotonic()
+            summary = await summarize_the_story_of_each_field(session_id, field, description, stat)
+            return summary, round(time.monotonic() - start, 2)
+
+    results = await asyncio.gather(*(summarize(field) for field in fields))
+
+    summarize_data = [
+        {"Field": field, "Summary": summary}
+        for field, (summary, _) in zip(fields, results)
+    ]
+    timings = {field: elapsed for field, (_, elapsed) in zip(fields, results)}
+    logging.info(f"[summarize_all_fields] Time per field (s): {timings}")
+
+    return summarize_data, timings
+
+
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
@@ -142,41 +174,36 @@ class Agency(BaseModel):
     intensity_level: str
     word_count: int
     purpose: str
+    stream: bool = False
 
 # Summarize story by Q and A, without having to summarize story for each field first
 async def llm_summarize_story_v3(session_id: str, agency: Agency, description: str):
     session_dir = UPLOAD_ROOT/session_id
     stat_file_path = session_dir / "stat.json"
 
-    with open(stat_file_path) as json_data:
-        stat = json.load(json_data)
-        fields = [field for field in stat["data"]["correlation"]]
-        summarize_data = []
-        for field in fields:
-            summary = summarize_the_story_of_each_field(session_id, field, description)
-            summarize_data.append({
-                "Field": field,
-                "Summary": summary
-            })
-        
+    stat_hash = await asyncio.to_thread(file_hash, stat_file_path)
+    stat = load_stat(stat_file_path)
+    fields = [field for field in stat["data"]["correlation"]]
+
+    # The graphs are sent to the LLM with the stats, they change with the colors and the dpi
+    graph_paths = [session_dir/"graph"/f"{field}.png" for field in fields]
+    graph_hash = await asyncio.to_thread(files_hash, graph_paths)
+    cache_key = narrative_cache_key(NARRATIVE_PIPELINE_VERSION, stat_hash, description, agency, graph_hash)
+
+    async def generate():
+        summarize_data, _ = await summarize_all_fields(session_id, fields, description, stat)
+
         logging.info(f"Summarize data: {summarize_data}")
 
         # Instantiate the chain
         data_story_chain = data_story_chain_generator_v3()
-        data_story_result = await data_story_chain.ainvoke({
+        return await send_narrative(session_id, data_story_chain, {
             "description": description,
             "q_and_a": summarize_data,
             "emotion": agency.emotion,
             "intensity_level": agency.intensity_level,
             "word_count": agency.word_count,
             "purpose": agency.purpose
-        })
-
-        logging.info(f"Data Story Result: {data_story_result}")
+        }, stream=agency.stream)
 
-        await websocket_manager.send_message(session_id, json.dumps({
-            "data": {
-                "title": "affective_narrative",
-                "result": data_story_result
-            }
-        }))
+    return await cached_narrative(session_id, cache_key, generate)
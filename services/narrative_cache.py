@@ -0,0 +1,113 @@
+"""
+Cache of the generated affective narratives
+
+A narrative is stored in Redis under the hash of (pipeline version, stat.json
+hash, graphs hash, description, agency), so the same request on the same data is answered
+without calling the LLM. Identical requests that arrive while a generation is
+running wait for it instead of starting their own (single flight), and every
+waiter sends the result to its own session.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from redis_manager import RedisManager
+from services.narrative_stream import send_result
+
+logging.basicConfig(level=logging.INFO)
+
+# Cached narratives expire after 24 hours by default
+NARRATIVE_CACHE_TTL = int(os.getenv("NARRATIVE_CACHE_TTL", 24*60*60))
+
+# key -> future of the generation in progress
+_inflight: dict[str, asyncio.Future] = {}
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def files_hash(paths):
+    """
+    files_hash
+    return the hash of the content of the files, a missing file counts as empty
+    """
+    sha256 = hashlib.sha256()
+    for path in paths:
+        sha256.update(f"{os.path.basename(path)}:".encode())
+        sha256.update((file_hash(path) if os.path.exists(path) else "missing").encode())
+    return sha256.hexdigest()
+
+
+def narrative_cache_key(pipeline_version: str, stat_hash: str, description, agency, graph_hash: str = None):
+    # stream only changes how the result is delivered, not the result
+    # graph_hash is set by the pipelines that send the graphs to the LLM
+    signature = json.dumps({
+        "pipeline_version": pipeline_version,
+        "stat_hash": stat_hash,
+        "graph_hash": graph_hash,
+        "description": description,
+        "agency": agency.model_dump(exclude={"stream"}),
+    }, sort_keys=True)
+
+    return f"narrative_cache:{hashlib.sha256(signature.encode()).hexdigest()}"
+
+
+async def get_cached_narrative(cache_key: str):
+    try:
+        return await RedisManager.get_client().get(cache_key)
+    except Exception as e:
+        logging.warning(f"[get_cached_narrative] Cannot read the cache: {e}")
+        return None
+
+
+async def set_cached_narrative(cache_key: str, result: str):
+    try:
+        await RedisManager.get_client().set(cache_key, result, ex=NARRATIVE_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"[set_cached_narrative] Cannot write the cache: {e}")
+
+
+async def cached_narrative(session_id: str, cache_key: str, generate):
+    """
+    cached_narrative
+    return the cached narrative or the result of generate(), which sends the
+    narrative to the session itself. Concurrent calls with the same key share
+    one generate() call
+    """
+    result = await get_cached_narrative(cache_key)
+    if result is not None:
+        logging.info("[cached_narrative] Narrative found in the cache, skipping the LLM calls")
+        await send_result(session_id, result)
+        return result
+
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        logging.info("[cached_narrative] Same narrative is being generated, waiting for it")
+        # shield so a cancelled waiter does not cancel the shared generation
+        result = await asyncio.shield(inflight)
+        await send_result(session_id, result)
+        return result
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    try:
+        result = await generate()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # retrieved here, the waiters get it re-raised
+        raise
+    else:
+        future.set_result(result)
+        await set_cached_narrative(cache_key, result)
+    finally:
+        _inflight.pop(cache_key, None)
+
+    return result
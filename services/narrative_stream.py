@@ -0,0 +1,61 @@
+import json
+import logging
+import time
+
+from ws.websocket import websocket_manager
+
+logging.basicConfig(level=logging.INFO)
+
+# Tokens received within this interval are sent in one delta frame
+STREAM_FLUSH_INTERVAL = 0.05  # seconds
+
+
+async def send_narrative(session_id: str, chain, inputs: dict, stream: bool = False):
+    """
+    send_narrative
+    run the narrative chain and send the result over the websocket
+    with stream=True the tokens are forwarded as affective_narrative_delta
+    frames while they are generated, the final affective_narrative message
+    is always sent so older clients keep working
+    """
+    if stream:
+        parts = []
+        pending = ""
+        last_flush = 0.0
+        async for token in chain.astream(inputs):
+            parts.append(token)
+            pending += token
+            if time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                await send_delta(session_id, pending)
+                pending = ""
+                last_flush = time.monotonic()
+
+        if pending:
+            await send_delta(session_id, pending)
+        result = "".join(parts)
+    else:
+        result = await chain.ainvoke(inputs)
+
+    logging.info(f"Data Story Result: {result}")
+    await send_result(session_id, result)
+
+    return result
+
+
+async def send_result(session_id: str, result: str):
+    await websocket_manager.send_message(session_id, json.dumps({
+        "data": {
+            "title": "affective_narrative",
+            "result": result
+        }
+    }))
+
+
+async def send_delta(session_id: str, delta: str):
+    # Not kept in the outbox, the final message carries the whole narrative
+    await websocket_manager.send_message(session_id, json.dumps({
+        "data": {
+            "title": "affective_narrative_delta",
+            "result": delta
+        }
+    }), durable=False)
@@ -0,0 +1,201 @@
+"""
+Year, month and week summaries of the numeric fields
+
+Rows are folded into per day aggregates (count, sum, min, max and the
+shifted sum / sum of squares for the standard deviation). Day aggregates
+merge across chunks and appends, and they roll up to every period without
+going back to the rows: one groupby over the rows, then one small groupby
+per period over the days.
+The metrics are rounded and converted to text column by column and not
+cell by cell.
+
+STAT_SUMMARY_PERIODS lists the periods written to stat.json, the yearly
+summary is always written (the narratives are built from it). Month and
+week summaries are opt-in: every entry also becomes a RAG chunk, a few
+years of data give about 65 times more chunks with both enabled.
+"""
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+PERIODS = ["year", "month", "week"]
+STAT_SUMMARY_PERIODS = [
+    period.strip() for period in os.getenv("STAT_SUMMARY_PERIODS", "year").split(",")
+    if period.strip() in PERIODS
+]
+
+# How the day aggregates of a period are merged
+MERGE = {"count": "sum", "sum": "sum", "shifted_sum": "sum", "shifted_sumsq": "sum", "min": "min", "max": "max"}
+
+
+class PeriodAggregates:
+    """
+    Mergeable per day aggregates of a set of numeric fields
+
+    Values are shifted by the first valid value of each field before the
+    sum of squares is taken, so the variance keeps its precision when the
+    values are large compared to their spread.
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.shift = np.full(len(self.fields), np.nan)
+        self.days = None  # aggregate name -> DataFrame indexed by day, one column per field
+
+    def add(self, values: np.ndarray, dates: pd.Series):
+        """
+        add
+        fold the rows into the day aggregates, values is a rows x fields
+        float array with NaN for the missing values
+        """
+        has_date = dates.notna().to_numpy()
+        if not has_date.any():
+            return
+
+        values = values[has_date]
+        days = dates.to_numpy()[has_date].astype("datetime64[D]")
+
+        valid = ~np.isnan(values)
+        new_shift = np.isnan(self.shift) & valid.any(axis=0)
+        if new_shift.any():
+            first_valid = valid.argmax(axis=0)
+            self.shift[new_shift] = values[first_valid, np.arange(values.shape[1])][new_shift]
+
+        frame = pd.DataFrame(values)
+        shifted = frame - np.nan_to_num(self.shift)
+        grouped = frame.groupby(days)
+        grouped_shifted = shifted.groupby(days)
+        aggregates = {
+            "count": grouped.count(),
+            "sum": grouped.sum(),
+            "shifted_sum": grouped_shifted.sum(),
+            "shifted_sumsq": (shifted * shifted).groupby(days).sum(),
+            "min": grouped.min(),
+            "max": grouped.max(),
+        }
+
+        if self.days is None:
+            self.days = aggregates
+        else:
+            self.days = {
+                name: pd.concat([self.days[name], aggregates[name]]).groupby(level=0).agg(how)
+                for name, how in MERGE.items()
+            }
+
+    def to_state(self):
+        """
+        to_state
+        return the aggregates as arrays, to be saved with np.savez
+        """
+        state = {"period_shift": self.shift}
+        if self.days is not None:
+            state["period_days"] = self.days["count"].index.to_numpy().astype("datetime64[D]").astype(np.int64)
+            for name in MERGE:
+                state[f"period_{name}"] = self.days[name].to_numpy(dtype=float)
+        return state
+
+    @classmethod
+    def from_state(cls, fields, state):
+        periods = cls(fields)
+        periods.shift = np.array(state["period_shift"], dtype=float)
+        if "period_days" in state:
+            index = pd.DatetimeIndex(np.asarray(state["period_days"]).astype("datetime64[D]"))
+            periods.days = {
+                name: pd.DataFrame(state[f"period_{name}"], index=index, columns=range(len(periods.fields)))
+                for name in MERGE
+            }
+        return periods
+
+    def rollup(self, period):
+        """
+        rollup
+        return the aggregates of each period, indexed by the period keys
+        (year), (year, month) or (ISO year, ISO week), sorted
+        """
+        index = pd.DatetimeIndex(self.days["count"].index)
+        if period == "year":
+            keys = [index.year]
+        elif period == "month":
+            keys = [index.year, index.month]
+        elif period == "week":
+            calendar = index.isocalendar()
+            keys = [calendar["year"].to_numpy(), calendar["week"].to_numpy()]
+        else:
+            raise ValueError(f"Unknown period {period}, expected one of {PERIODS}")
+
+        return {name: self.days[name].groupby(keys).agg(how) for name, how in MERGE.items()}
+
+    def summarize(self, period, fields=None):
+        """
+        summarize
+        return the stat.json entries of the period for the given fields
+        """
+        if self.days is None:
+            return []
+
+        fields = self.fields if fields is None else fields
+        columns = [self.fields.index(field) for field in fields]
+        aggregates = self.rollup(period)
+
+        count = aggregates["count"][columns].to_numpy(dtype=float)
+        total = aggregates["sum"][columns].to_numpy(dtype=float)
+        shifted_sum = aggregates["shifted_sum"][columns].to_numpy(dtype=float)
+        shifted_sumsq = aggregates["shifted_sumsq"][columns].to_numpy(dtype=float)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(count > 0, total / count, np.nan)
+            variance = (shifted_sumsq - shifted_sum * shifted_sum / count) / (count - 1)
+            std = np.where(count > 1, np.sqrt(np.clip(variance, 0, None)), np.nan)
+
+        metrics = {
+            "mean": format_values(mean),
+            "max": format_values(aggregates["max"][columns].to_numpy(dtype=float)),
+            "min": format_values(aggregates["min"][columns].to_numpy(dtype=float)),
+            "std": format_values(std),
+        }
+
+        entries = []
+        for row, key in enumerate(aggregates["count"].index):
+            entry = period_entry(period, key)
+            entry["metrics"] = {
+                field: {name: values[row, i] for name, values in metrics.items()}
+                for i, field in enumerate(fields)
+            }
+            entries.append(entry)
+
+        return entries
+
+    def to_summaries(self, fields=None, periods=STAT_SUMMARY_PERIODS):
+        """
+        to_summaries
+        return the summary_by_<period> keys of stat.json
+        """
+        periods = ["year", *(period for period in periods if period != "year")]
+        return {f"summary_by_{period}": self.summarize(period, fields) for period in periods}
+
+
+def format_values(values: np.ndarray):
+    """
+    format_values
+    round to 2 decimals and convert to text in bulk, missing values are 0
+    """
+    text = np.round(values, 2).astype(str).astype(object)
+    text[np.isnan(values)] = 0
+    return text
+
+
+def period_entry(period, key):
+    if period == "year":
+        return {"year": int(key)}
+    if period == "month":
+        return {"year": int(key[0]), "month": int(key[1])}
+
+    year, week = int(key[0]), int(key[1])
+    return {
+        "year": year,
+        "week": week,
+        "start_date": datetime.date.fromisocalendar(year, week, 1).isoformat(),
+    }
@@ -1,91 +1,183 @@
+import hashlib
 import logging
-import json
-
-
-from concurrent.futures import ThreadPoolExecutor
+import os
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import CSVLoader
 from langchain_ollama import OllamaEmbeddings
 from langchain.schema import Document
 
-from chromadb.config import Settings
-from chromadb import Client
+from services.embedding_cache import CachedEmbeddings
+from vector_store_manager import VectorStoreManager
+from services.stat_store import load_stat
 
 
 # from ws.websocket import websocket_manager
-chroma_client = Client(Settings())
+embedding_function = CachedEmbeddings(
+    OllamaEmbeddings(
+        model="deepseek-r1:7b",
+        base_url="http://host.docker.internal:11434" 
+    ),
+    model="deepseek-r1:7b"
+)
 
 logging.basicConfig(level = logging.INFO)
 
+# Number of chunks embedded per request to the embedding model
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+
+
+def chunk_id(text):
+    # Content based, an unchanged chunk keeps its id across re-indexing
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def index_chunks(session_id, chunks, batch_size=EMBED_BATCH_SIZE):
+    """
+    index_chunks
+    (re)create the session collection, embed the chunks batch by batch and
+    add every batch to the collection in one call
+    """
+    collection = VectorStoreManager.create_collection(session_id)
+
+    logging.info(f"[index_chunks] There are a total of {len(chunks)} chunks")
+    _add_chunks(session_id, collection, list(enumerate(chunks)), batch_size)
+
+    return collection
+
+
+def update_chunks(session_id, chunks, batch_size=EMBED_BATCH_SIZE):
+    """
+    update_chunks
+    bring an existing session collection up to date with chunks: the
+    chunks whose text changed are removed and only the new ones are
+    embedded, return None when the session has no collection
+    """
+    collection = VectorStoreManager.get_collection(session_id)
+    if collection is None:
+        return None
+
+    existing = set(collection.get(include=[])["ids"])
+    ids = {chunk_id(chunk.page_content) for chunk in chunks}
+    stale = sorted(existing - ids)
+    new = [(idx, chunk) for idx, chunk in enumerate(chunks) if chunk_id(chunk.page_content) not in existing]
+
+    logging.info(f"[update_chunks] Removing {len(stale)} chunks, adding {len(new)} chunks")
+    VectorStoreManager.delete(session_id, collection, stale)
+    _add_chunks(session_id, collection, new, batch_size)
+
+    return collection
+
+
+def _add_chunks(session_id, collection, indexed_chunks, batch_size):
+    # Identical texts share an id, they are added once
+    unique = {}
+    for idx, chunk in indexed_chunks:
+        unique.setdefault(chunk_id(chunk.page_content), (idx, chunk))
+    indexed_chunks = list(unique.items())
+
+    for start in range(0, len(indexed_chunks), batch_size):
+        batch = indexed_chunks[start:start + batch_size]
+        texts = [chunk.page_content for _, (_, chunk) in batch]
+
+        VectorStoreManager.add(
+            session_id,
+            collection,
+            documents=texts,
+            embeddings=embedding_function.embed_documents(texts),
+            metadatas=[{'id': idx} for _, (idx, _) in batch],
+            ids=[key for key, _ in batch]
+        )
+
 def convert_stat_to_text(stat_file_path):
-    with open(stat_file_path) as json_data:
-        stat = json.load(json_data)
-
-        info = []
-        for key in stat['data']:
-            logging.info(key)
-            logging.info(stat['data'][key])
-            if key == "fields":
-                text = "The dataset includes the following columns:"
-                for field_name in stat['data'][key]:
-                    text = text + ", " + field_name
-                text = text + ". These fields represent the data."
-                info.append(text)
-
-            if key == "date":
-                text = f"Timespan | Date | Time period = The dataset consists of the data from {stat['data'][key]['start_date']} to {stat['data'][key]['end_date']}" 
-                info.append(text)
-            
-            if key == "stat":
-                for field in stat["data"]["stat"]:
-                    s = stat["data"]["stat"][field] 
-                    text = (f"""For the whole period, This is the summary statistics of the field {field}: """ 
-                    f"""the mean value is {s["mean"]}, """
-                    f"""the min value is {s["min"]}, """
-                    f"""the max value is {s["max"]}, """
-                    f"""the median is {s["median"]}, """
-                    f"""the sd value is {s["sd"]}""") 
-
-                    info.append(text.rstrip())
-            
-            if key == "correlation":
-                text = "The correlation between each fields are as follow, "
+    stat = load_stat(stat_file_path)
+    info = []
+    for key in stat['data']:
+        logging.info(key)
+        logging.info(stat['data'][key])
+        if key == "fields":
+            text = "The dataset includes the following columns:"
+            for field_name in stat['data'][key]:
+                text = text + ", " + field_name
+            text = text + ". These fields represent the data."
+            info.append(text)
+
+        if key == "date":
+            text = f"Timespan | Date | Time period = The dataset consists of the data from {stat['data'][key]['start_date']} to {stat['data'][key]['end_date']}" 
+            info.append(text)
+        
+        if key == "stat":
+            for field in stat["data"]["stat"]:
+                s = stat["data"]["stat"][field] 
+                text = (f"""For the whole period, This is the summary statistics of the field {field}: """ 
+                f"""the mean value is {s["mean"]}, """
+                f"""the min value is {s["min"]}, """
+                f"""the max value is {s["max"]}, """
+                f"""the median is {s["median"]}, """
+                f"""the sd value is {s["sd"]}""") 
+
+                info.append(text.rstrip())
+        
+        if key == "correlation":
+            text = "The correlation between each fields are as follow, "
+            content = ""
+            # The correlation is symmetric, each pair is written once
+            seen = set()
+            for field in stat["data"]["correlation"]:
+                c = stat["data"]["correlation"][field]
+                for other_field in c:
+                    if (other_field, field) in seen:
+                        continue
+                    seen.add((field, other_field))
+                    content = content + f"{field} and {other_field} is {c[other_field]}. "
+
+            info.append(text+content)
+        
+        if key == "summary_by_month":
+            for monthly_stat in stat["data"]["summary_by_month"]:
+                text = f"This is the statistics summary of the month: {monthly_stat['month']}, year: {monthly_stat['year']}. "
+                content = ""
+                for key_field in monthly_stat["metrics"]:
+                    content = content + (
+                        f"""The {key_field}: max is {monthly_stat["metrics"][key_field]["max"]}, """
+                        f"""mean is {monthly_stat["metrics"][key_field]["mean"]}, """ 
+                        f"""min is {monthly_stat["metrics"][key_field]["min"]}, """ 
+                        f"""sd is {monthly_stat["metrics"][key_field]["std"]}. """ 
+                     )
+                
+                info.append(text+content)    
+
+        if key == "summary_by_week":
+            for weekly_stat in stat["data"]["summary_by_week"]:
+                text = f"This is the statistics summary of the week: {weekly_stat['week']}, year: {weekly_stat['year']}, starting on {weekly_stat['start_date']}. "
                 content = ""
-                for field in stat["data"]["correlation"]:
-                    c = stat["data"]["correlation"][field]
-                    for other_field in c:
-                        content = content + f"{field} and {other_field} is {c[other_field]}. "
+                for key_field in weekly_stat["metrics"]:
+                    content = content + (
+                        f"""The {key_field}: max is {weekly_stat["metrics"][key_field]["max"]}, """
+                        f"""mean is {weekly_stat["metrics"][key_field]["mean"]}, """
+                        f"""min is {weekly_stat["metrics"][key_field]["min"]}, """
+                        f"""sd is {weekly_stat["metrics"][key_field]["std"]}. """
+                     )
 
                 info.append(text+content)
-            
-            if key == "summary_by_month":
-                for monthly_stat in stat["data"]["summary_by_month"]:
-                    text = f"This is the statistics summary of the month: {monthly_stat['month']}, year: {monthly_stat['year']}. "
-                    content = ""
-                    for key_field in monthly_stat["metrics"]:
-                        content = content + (
-                            f"""The {key_field}: max is {monthly_stat["metrics"][key_field]["max"]}, """
-                            f"""mean is {monthly_stat["metrics"][key_field]["mean"]}, """ 
-                            f"""min is {monthly_stat["metrics"][key_field]["min"]}, """ 
-                            f"""sd is {monthly_stat["metrics"][key_field]["std"]}. """ 
-                         )
-                    
-                    info.append(text+content)    
-            
-            if key == "summary_by_year":
-                for yearly_stat in stat["data"]["summary_by_year"]:
-                    text = f"This is the statistics summary of the whole year: {yearly_stat['year']}. "
-                    content = ""
-                    for key_field in yearly_stat["metrics"]:
-                        content = content + (
-                            f"""The {key_field}: max is {yearly_stat["metrics"][key_field]["max"]}, """
-                            f"""mean is {yearly_stat["metrics"][key_field]["mean"]}, """ 
-                            f"""min is {yearly_stat["metrics"][key_field]["min"]}, """ 
-                            f"""sd is {yearly_stat["metrics"][key_field]["std"]}. """ 
-                         )
-                    
-                    info.append(text+content)
+        
+        if key == "summary_by_year":
+            for yearly_stat in stat["data"]["summary_by_year"]:
+                text = f"This is the statistics summary of the whole year: {yearly_stat['year']}. "
+                content = ""
+                for key_field in yearly_stat["metrics"]:
+                    content = content + (
+                        f"""The {key_field}: max is {yearly_stat["metrics"][key_field]["max"]}, """
+                        f"""mean is {yearly_stat["metrics"][key_field]["mean"]}, """ 
+                        f"""min is {yearly_stat["metrics"][key_field]["min"]}, """ 
+                        f"""sd is {yearly_stat["metrics"][key_field]["std"]}"""
+                     )
+                    # Sessions uploaded before the percentiles were added have no median
+                    if "median" in yearly_stat["metrics"][key_field]:
+                        content = content + f""", median is {yearly_stat["metrics"][key_field]["median"]}"""
+                    content = content + ". "
+                
+                info.append(text+content)
     
     return info
     
@@ -118,35 +210,5 @@ async def prepare_rag(csv_file_path, stat_file_path, session_id):
 
     logging.info(chunks)
 
-    logging.info("[prepare_rag] Prepare the embedding functions...")
-    embedding_function = OllamaEmbeddings(
-        model="deepseek-r1:7b",
-        base_url="http://host.docker.internal:11434" 
-    )
-
-
-    def generate_embedding(chunk):
-        return embedding_function.embed_query(chunk.page_content)
-    
     logging.info("[prepare_rag] Generating embeddings...")
-    with ThreadPoolExecutor() as executor:
-        embeddings = list(executor.map(generate_embedding, chunks))
-
-    logging.info("[prepare_rag] Initialize chroma...")
-
-    try:
-        chroma_client.delete_collection(name=session_id)  # Delete existing collection (if any)
-    except:
-        None
-    collection = chroma_client.create_collection(name=session_id)
-
-    logging.info(f"-----> There are a total of {len(chunks)} chunks")
-    for idx, chunk in enumerate(chunks):
-        collection.add(
-            documents=[chunk.page_content], 
-            metadatas=[{'id': idx}], 
-            embeddings=[embeddings[idx]], 
-            ids=[str(idx)]  # Ensure IDs are strings
-        )
-
-    
\ No newline at end of file
+    index_chunks(session_id, chunks)
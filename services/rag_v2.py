@@ -1,85 +1,103 @@
+import os
 import re
 import time
 import logging
 import json
 
+from collections import OrderedDict
 
-from concurrent.futures import ThreadPoolExecutor
+from services.rag import convert_stat_to_text, index_chunks, update_chunks, embedding_function
+from vector_store_manager import VectorStoreManager
 
-from services.rag import convert_stat_to_text
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import CSVLoader
 from langchain_chroma import Chroma
-from langchain_ollama import OllamaLLM, OllamaEmbeddings
+from langchain_ollama import OllamaLLM
 from langchain.schema import Document
 
-from chromadb.config import Settings
-from chromadb import Client
 
-chroma_client = Client(Settings())
-embedding_function = OllamaEmbeddings(
+# One client for every question, its HTTP connections are reused and
+# keep_alive keeps the model loaded in Ollama between questions
+llm = OllamaLLM(
     model="deepseek-r1:7b",
-    base_url="http://host.docker.internal:11434" 
+    base_url="http://host.docker.internal:11434",
+    keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m")
 )
 
-def chunking_and_embedding(stat_file_path, session_id): 
+# session_id -> (collection id, retriever)
+_retrievers = OrderedDict()
+MAX_CACHED_RETRIEVERS = 256
+
+
+def get_stat_chunks(stat_file_path):
     stat_summary_text = convert_stat_to_text(stat_file_path)
-    stat_chunks = [
+    return [
         Document(page_content=text, metadata={"source": "stat.json", "type": "summary"})
         for text in stat_summary_text
     ]
 
-    logging.info("Stat chunks: ", stat_chunks)
-    logging.info("[prepare_rag] Prepare the embedding functions...")
 
-    def generate_embedding(chunk):
-        return embedding_function.embed_query(chunk.page_content)
-    
+def chunking_and_embedding(stat_file_path, session_id): 
+    stat_chunks = get_stat_chunks(stat_file_path)
+
+    logging.info(f"Stat chunks: {stat_chunks}")
     logging.info("[prepare_rag] Generating embeddings...")
-    with ThreadPoolExecutor() as executor:
-        embeddings = list(executor.map(generate_embedding, stat_chunks))
+    index_chunks(session_id, stat_chunks)
 
-    logging.info("[prepare_rag] Initialize chroma...")
-    
-    try:
-        chroma_client.delete_collection(name=session_id)  # Delete existing collection (if any)
-    except:
-        None
-    collection = chroma_client.create_collection(name=session_id)
-
-    for idx, chunk in enumerate(stat_chunks):
-        collection.add(
-            documents=[chunk.page_content], 
-            metadatas=[{'id': idx}], 
-            embeddings=[embeddings[idx]], 
-            ids=[str(idx)]  # Ensure IDs are strings
-        )
+
+def refresh_stat_chunks(stat_file_path, session_id):
+    """
+    refresh_stat_chunks
+    update the session collection after stat.json changed, only the chunks
+    of the periods that changed are embedded again
+    """
+    return update_chunks(session_id, get_stat_chunks(stat_file_path))
     
 
 
-def ask_llm_with_rag(session_id, question):
-    logging.info("[ask_llm_with_rag] Initialize retriever using Ollama embeddings for queries...")
-    start = time.time()
-    retriever = Chroma(collection_name=session_id, client=chroma_client, embedding_function=embedding_function).as_retriever()
-    logging.info(f"Retriever processing time => {time.time() - start}")
+def get_retriever(session_id):
+    """
+    get_retriever
+    return the cached retriever of the session, a new one is built only when
+    the session collection was (re)created since the last question
+    """
+    collection = VectorStoreManager.get_collection(session_id)
+    if collection is None:
+        return None
 
-    def retrieve_context(question):
-        results = retriever.invoke(question)
+    cached = _retrievers.get(session_id)
+    if cached is not None and cached[0] == collection.id:
+        _retrievers.move_to_end(session_id)
+        return cached[1]
+
+    logging.info(f"[get_retriever] Initialize retriever for session {session_id}")
+    retriever = Chroma(
+        collection_name=session_id,
+        client=VectorStoreManager.get_client(),
+        embedding_function=embedding_function
+    ).as_retriever()
+
+    _retrievers[session_id] = (collection.id, retriever)
+    if len(_retrievers) > MAX_CACHED_RETRIEVERS:
+        _retrievers.popitem(last=False)
+
+    return retriever
+
+
+async def ask_llm_with_rag(session_id, question):
+    retriever = get_retriever(session_id)
+    if retriever is None:
+        raise ValueError(f"No collection found for session {session_id}")
+
+    async def retrieve_context(question):
+        results = await retriever.ainvoke(question)
         context = "\n\n".join([doc.page_content for doc in results])
         return context
-    
-
-    logging.info("[prepare_rag] Start LLM...")
-    llm = OllamaLLM(
-        model="deepseek-r1:7b",
-        base_url="http://host.docker.internal:11434" 
-    ) 
 
-    def query_deepseek(question, context):
+    async def query_deepseek(question, context):
         formatted_prompt = f"Question: {question}\n\nContext: {context}"
 
-        response = llm.invoke(formatted_prompt)
+        start = time.time()
+        response = await llm.ainvoke(formatted_prompt)
+        logging.info(f"LLM processing time => {time.time() - start}")
 
         response_content = response
         logging.info(f"Full response from deepseek: {response_content}")
@@ -87,14 +105,14 @@ def ask_llm_with_rag(session_id, question):
 
         return final_answer
 
-    def ask_question(question):
-        context = retrieve_context(question)
+    async def ask_question(question):
+        context = await retrieve_context(question)
         logging.info(f"Context from RAG retrival: {context}")
-        answer = query_deepseek(question, context)
+        answer = await query_deepseek(question, context)
         return answer
     
     logging.info(f"Asking Question: {question} .......")
-    res = ask_question(question)
+    res = await ask_question(question)
     logging.info(res)
 
-    return res
\ No newline at end of file
+    return res
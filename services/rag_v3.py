@@ -1,18 +1,36 @@
 import logging
 
-from langchain_community.document_loaders import CSVLoader
+import pandas as pd
+
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
+
+from services.rag import index_chunks
 
 logging.basicConfig(level = logging.INFO)
 
+
+def load_row_documents(csv_file_path):
+    """
+    load_row_documents
+    one document per row with the same "column: value" lines as CSVLoader,
+    the values are the raw CSV strings (dtype=str, no NaN conversion) and
+    the lines are joined column by column instead of row by row
+    """
+    df = pd.read_csv(csv_file_path, dtype=str, keep_default_na=False).fillna("")
+
+    lines = [str(column).strip() + ": " + df[column].str.strip() for column in df.columns]
+    contents = lines[0].str.cat(lines[1:], sep="\n") if lines else pd.Series([], dtype=str)
+
+    return [
+        Document(page_content=content, metadata={"source": str(csv_file_path), "row": row})
+        for row, content in enumerate(contents)
+    ]
+
+
 async def prepare_rag(csv_file_path, session_id):
-    csv_loader = CSVLoader(file_path=csv_file_path,
-        csv_args={
-        'delimiter': ','
-    })
-    
     logging.info("[prepare_rag] Load documents...")
-    csv_documents = csv_loader.load()
+    csv_documents = load_row_documents(csv_file_path)
 
     logging.info("[prepare_rag] Split to chunks")
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=50)
@@ -20,33 +38,5 @@ async def prepare_rag(csv_file_path, session_id):
 
     logging.info(csv_chunks)
 
-    logging.info("[prepare_rag] Prepare the embedding functions...")
-    embedding_function = OllamaEmbeddings(
-        model="deepseek-r1:7b",
-        base_url="http://host.docker.internal:11434" 
-    )
-
-
-    def generate_embedding(chunk):
-        return embedding_function.embed_query(chunk.page_content)
-    
     logging.info("[prepare_rag] Generating embeddings...")
-    with ThreadPoolExecutor() as executor:
-        embeddings = list(executor.map(generate_embedding, csv_chunks))
-
-    logging.info("[prepare_rag] Initialize chroma...")
-
-    try:
-        chroma_client.delete_collection(name=session_id)  # Delete existing collection (if any)
-    except:
-        None
-    collection = chroma_client.create_collection(name=session_id)
-
-    logging.info(f"-----> There are a total of {len(csv_chunks)} chunks")
-    for idx, chunk in enumerate(csv_chunks):
-        collection.add(
-            documents=[chunk.page_content], 
-            metadatas=[{'id': idx}], 
-            embeddings=[embeddings[idx]], 
-            ids=[str(idx)]  # Ensure IDs are strings
-        )
\ No newline at end of file
+    index_chunks(session_id, csv_chunks)
@@ -1,43 +1,122 @@
-import logging
+"""
+Session state store
+
+Everything known about a session is kept in one Redis hash, session:<id>,
+with the fields listed in SESSION_FIELDS. Any subset of fields is read with a
+single HMGET, and the session TTL is refreshed in the same round trip.
+Reads go through a short-lived in-process cache (SESSION_CACHE_TTL seconds,
+0 disables it), so one request touches Redis at most once.
+
+The topic and the instruction may still be written by other services to the
+legacy JSON keys <id>_topic and <id>_instruction. They are read in the same
+round trip and used when the hash field is not set.
+"""
+
 import json
+import logging
+import os
+import time
 
-from redis_manager import RedisManager
+from redis_manager import RedisManager, SESSION_TTL
 
-def get_description_from_redis(session_id):
-    redis_client = RedisManager.get_client()
-    res = redis_client.get(session_id)
-    logging.info(f"Get data from redis: {res}")
+logging.basicConfig(level=logging.INFO)
 
-    if res is None:
-        return None
-    
-    json_res = json.loads(res)
+SESSION_FIELDS = ("status", "description", "core_concept", "instruction")
+LEGACY_KEYS = {"core_concept": "{}_topic", "instruction": "{}_instruction"}
 
-    return json_res["description"]
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 5))
+SESSION_CACHE_MAX_ENTRIES = 1024
 
+# session_id -> (expires_at, {field: value})
+_cache: dict[str, tuple[float, dict]] = {}
 
-def get_core_concept(session_id):
-    redis_client = RedisManager.get_client()
-    res = redis_client.get(f"{session_id}_topic")
-    logging.info(f"Get core concept from redis: {res}")
 
-    if res is None:
-        return None
-    json_res = json.loads(res)
+def session_key(session_id):
+    return f"session:{session_id}"
 
-    return json_res["core_concept"] if "core_concept" in json_res else None
 
-def get_description_instruction(session_id):
-    redis_client = RedisManager.get_client()
-    res = redis_client.get(f"{session_id}_instruction")
-    logging.info(f"Get instruction from redis: {res}")
+async def set_session_state(session_id, **fields):
+    """
+    set_session_state
+    write the given fields of the session and refresh its TTL in one round trip
+    """
+    mapping = {field: value for field, value in fields.items() if value is not None}
+    async with RedisManager.get_client().pipeline(transaction=True) as pipe:
+        pipe.hset(session_key(session_id), mapping=mapping)
+        pipe.expire(session_key(session_id), SESSION_TTL)
+        await pipe.execute()
+
+    _cache.pop(session_id, None)
+    logging.debug(f"[set_session_state] {session_id}: {list(mapping)}")
 
-    if res is None:
-        return None
-    
-    json_res = json.loads(res)
 
-    if json_res["is_there_any_instruction"]:
-        return json_res["instruction"] if "instruction" in json_res else None
+async def get_session_state(session_id, *fields):
+    """
+    get_session_state
+    return {field: value} for the requested fields (all of them by default),
+    None for the fields that are not set
+    """
+    fields = fields or SESSION_FIELDS
+    cached = _cache.get(session_id)
+    if cached is None or cached[0] < time.monotonic():
+        # Read every field, the other readers of the request hit the cache
+        async with RedisManager.get_client().pipeline(transaction=True) as pipe:
+            pipe.hmget(session_key(session_id), SESSION_FIELDS)
+            pipe.expire(session_key(session_id), SESSION_TTL)
+            for legacy_key in LEGACY_KEYS.values():
+                pipe.get(legacy_key.format(session_id))
+            values, _, *legacy_values = await pipe.execute()
+
+        state = dict(zip(SESSION_FIELDS, values))
+        for field, legacy_value in zip(LEGACY_KEYS, legacy_values):
+            if state[field] is None and legacy_value is not None:
+                state[field] = parse_legacy_value(field, legacy_value)
+        logging.debug(f"[get_session_state] {session_id}: {[field for field, value in state.items() if value is not None]}")
+        if SESSION_CACHE_TTL > 0:
+            _cache_state(session_id, state)
     else:
+        state = cached[1]
+
+    return {field: state.get(field) for field in fields}
+
+
+def parse_legacy_value(field, value):
+    """
+    parse_legacy_value
+    return the field from its legacy JSON value, None when it is not set
+    """
+    try:
+        value = json.loads(value)
+    except ValueError:
+        value = None
+    if not isinstance(value, dict):
+        logging.warning(f"[get_session_state] Invalid legacy {field} of the session")
+        return None
+
+    # The legacy instruction is only set when there is one
+    if field == "instruction" and not value.get("is_there_any_instruction"):
         return None
+    return value.get(field)
+
+
+def _cache_state(session_id, state):
+    now = time.monotonic()
+    if len(_cache) >= SESSION_CACHE_MAX_ENTRIES:
+        for expired_id in [key for key, (expires_at, _) in _cache.items() if expires_at < now]:
+            del _cache[expired_id]
+        if len(_cache) >= SESSION_CACHE_MAX_ENTRIES:
+            _cache.clear()
+    _cache[session_id] = (now + SESSION_CACHE_TTL, state)
+
+
+async def get_description_from_redis(session_id):
+    return (await get_session_state(session_id, "description"))["description"]
+
+
+async def get_core_concept(session_id):
+    return (await get_session_state(session_id, "core_concept"))["core_concept"]
+
+
+async def get_description_instruction(session_id):
+    # The instruction is only set when there is one
+    return (await get_session_state(session_id, "instruction"))["instruction"]
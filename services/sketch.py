@@ -0,0 +1,305 @@
+"""
+Quantiles and samples of the numeric fields in bounded memory
+
+While the dataset has at most STAT_EXACT_MAX_VALUES numeric values (rows x
+numeric fields, missing values excluded) each value is kept once with its
+year, and the quantiles of the whole dataset and of every year are exact
+(same as Series.quantile). The limit is checked before a chunk is added, so
+the kept values never go over it.
+
+Above it every field gets KLL sketches, for the whole dataset and per year:
+values go to the lowest level and a level holding more than its capacity is
+sorted and halved, every other value moves up one level with twice the
+weight. Memory is O(k log n) per sketch and the rank error of a quantile is
+about STAT_QUANTILE_ERROR (k is derived from it with the DataSketches
+approximation of the KLL error). STAT_APPROXIMATE=always uses the sketches
+from the first row, never keeps every value.
+
+ReservoirSample keeps a uniform sample of STAT_SAMPLE_SIZE rows, used for the
+statistics that do not merge (Spearman ranks) when the stats are approximate.
+"""
+
+import math
+import os
+
+import numpy as np
+
+STAT_APPROXIMATE_MODES = ["auto", "always", "never"]
+STAT_APPROXIMATE = os.getenv("STAT_APPROXIMATE", "auto")
+STAT_EXACT_MAX_VALUES = int(os.getenv("STAT_EXACT_MAX_VALUES", 2_000_000))
+STAT_QUANTILE_ERROR = float(os.getenv("STAT_QUANTILE_ERROR", 0.01))
+STAT_SAMPLE_SIZE = int(os.getenv("STAT_SAMPLE_SIZE", 10_000))
+STAT_PERCENTILES = sorted({
+    50,
+    *(int(percentile) for percentile in os.getenv("STAT_PERCENTILES", "25,50,75").split(",") if percentile.strip()),
+})
+
+# Year of the values without a date, they only count for the whole dataset
+NO_YEAR = -1
+
+
+def is_approximate(values, mode=STAT_APPROXIMATE):
+    if mode not in STAT_APPROXIMATE_MODES:
+        raise ValueError(f"Unknown approximate mode {mode}, expected one of {STAT_APPROXIMATE_MODES}")
+    return mode == "always" or (mode == "auto" and values > STAT_EXACT_MAX_VALUES)
+
+
+def sketch_k(error=STAT_QUANTILE_ERROR):
+    """
+    sketch_k
+    return the KLL parameter giving a normalized rank error of about error
+    """
+    return max(8, math.ceil((2.296 / error) ** (1 / 0.9723)))
+
+
+def percentile_name(percentile):
+    return "median" if percentile == 50 else f"p{percentile}"
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch of one field
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.nan
+        self.max = np.nan
+
+    def update(self, values: np.ndarray):
+        """
+        update
+        add the values, without missing values
+        """
+        if not len(values):
+            return
+
+        self.count += len(values)
+        self.min = np.fmin(self.min, values.min())
+        self.max = np.fmax(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                items = np.sort(items)
+                # An odd item stays, the others are paired and one of each pair
+                # moves up. The offset is drawn from the count so that the same
+                # rows always give the same stats (and the same cache keys)
+                odd = len(items) % 2
+                offset = np.random.default_rng(self.count + level).integers(2)
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[odd + offset::2]])
+                self.levels[level] = items[:odd]
+            level += 1
+
+    def quantiles(self, qs):
+        """
+        quantiles
+        return the values at the ranks qs (0 to 1), NaN without values
+        """
+        if self.count == 0:
+            return np.full(len(qs), np.nan)
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative, np.asarray(qs) * cumulative[-1], side="left")
+        return items[order][np.clip(index, 0, len(items) - 1)]
+
+
+class QuantileSketches:
+    """
+    Quantiles of every field over the whole dataset and per year, exact
+    until compress is called, from KLL sketches after
+    """
+
+    def __init__(self, width, k=None):
+        self.width = width
+        self.k = sketch_k() if k is None else k
+        self.exact = True
+        self.size = 0  # number of values kept while exact
+        self.values = {}  # field index -> list of value arrays, while exact
+        self.years = {}  # field index -> list of year arrays, while exact
+        self.sketches = {}  # (year or NO_YEAR for the whole dataset, field index) -> QuantileSketch
+
+    def update(self, values: np.ndarray, years: np.ndarray):
+        """
+        update
+        add the rows, values is a rows x width float array with NaN for the
+        missing values, years is NO_YEAR for the rows without a date
+        """
+        for i in range(self.width):
+            column = values[:, i]
+            valid = ~np.isnan(column)
+            if not valid.any():
+                continue
+
+            if self.exact:
+                self.values.setdefault(i, []).append(column[valid])
+                self.years.setdefault(i, []).append(years[valid])
+                self.size += int(valid.sum())
+            else:
+                self._update_sketches(i, column[valid], years[valid])
+
+    def compress(self):
+        """
+        compress
+        move the kept values to sketches, the quantiles are approximate after
+        """
+        self.exact = False
+        for i in list(self.values):
+            self._update_sketches(i, np.concatenate(self.values.pop(i)), np.concatenate(self.years.pop(i)))
+        self.size = 0
+
+    def summarize(self, i, qs):
+        """
+        summarize
+        return min, max and quantiles of the field i over the whole dataset and
+        {year: quantiles}, None when the field has no values
+        """
+        if self.exact:
+            if i not in self.values:
+                return None
+            values, years = np.concatenate(self.values[i]), np.concatenate(self.years[i])
+            by_year = {
+                year: np.quantile(group, qs)
+                for year, group in split_by_year(values, years)
+            }
+            return values.min(), values.max(), np.quantile(values, qs), by_year
+
+        sketch = self.sketches.get((NO_YEAR, i))
+        if sketch is None:
+            return None
+        by_year = {
+            year: year_sketch.quantiles(qs)
+            for (year, field), year_sketch in self.sketches.items()
+            if field == i and year != NO_YEAR
+        }
+        return sketch.min, sketch.max, sketch.quantiles(qs), by_year
+
+    def _update_sketches(self, i, values, years):
+        self._sketch(NO_YEAR, i).update(values)
+        for year, group in split_by_year(values, years):
+            self._sketch(year, i).update(group)
+
+    def _sketch(self, year, i):
+        sketch = self.sketches.get((year, i))
+        if sketch is None:
+            sketch = self.sketches[(year, i)] = QuantileSketch(self.k)
+        return sketch
+
+    def to_state(self):
+        """
+        to_state
+        return the kept values or the sketches as flat arrays, to be saved
+        with np.savez
+        """
+        fields = sorted(self.values)
+        sketches = list(self.sketches.items())
+        return {
+            "sketch_k": np.array(self.k),
+            "sketch_exact": np.array(self.exact),
+            "exact_fields": np.array(fields, dtype=np.int64),
+            "exact_sizes": np.array([sum(len(part) for part in self.values[i]) for i in fields], dtype=np.int64),
+            "exact_values": np.concatenate([part for i in fields for part in self.values[i]]) if fields else np.empty(0),
+            "exact_years": np.concatenate([part for i in fields for part in self.years[i]]) if fields else np.empty(0, dtype=np.int32),
+            "sketch_keys": np.array([key for key, _ in sketches], dtype=np.int64).reshape(-1, 2),
+            "sketch_meta": np.array([
+                [sketch.count, sketch.min, sketch.max] for _, sketch in sketches
+            ], dtype=float).reshape(-1, 3),
+            "sketch_num_levels": np.array([len(sketch.levels) for _, sketch in sketches], dtype=np.int64),
+            "sketch_level_sizes": np.array([
+                len(level) for _, sketch in sketches for level in sketch.levels
+            ], dtype=np.int64),
+            "sketch_items": np.concatenate([
+                level for _, sketch in sketches for level in sketch.levels
+            ]) if sketches else np.empty(0),
+        }
+
+    @classmethod
+    def from_state(cls, width, state):
+        sketches = cls(width, int(state["sketch_k"]))
+        sketches.exact = bool(state["sketch_exact"])
+
+        position = 0
+        for i, size in zip(state["exact_fields"].tolist(), state["exact_sizes"].tolist()):
+            sketches.values[i] = [state["exact_values"][position:position + size]]
+            sketches.years[i] = [state["exact_years"][position:position + size]]
+            sketches.size += size
+            position += size
+
+        level_sizes = iter(state["sketch_level_sizes"].tolist())
+        items = state["sketch_items"]
+        position = 0
+        for key, meta, num_levels in zip(state["sketch_keys"].tolist(), state["sketch_meta"], state["sketch_num_levels"].tolist()):
+            sketch = QuantileSketch(sketches.k)
+            sketch.count, sketch.min, sketch.max = int(meta[0]), meta[1], meta[2]
+            sketch.levels = []
+            for _ in range(num_levels):
+                size = next(level_sizes)
+                sketch.levels.append(items[position:position + size])
+                position += size
+            sketches.sketches[tuple(key)] = sketch
+
+        return sketches
+
+
+def split_by_year(values, years):
+    """
+    split_by_year
+    yield (year, values of the year), the values without a year are skipped
+    """
+    has_year = years != NO_YEAR
+    values, years = values[has_year], years[has_year]
+    order = np.argsort(years, kind="stable")
+    keys, starts = np.unique(years[order], return_index=True)
+    yield from zip(keys.tolist(), np.split(values[order], starts[1:]))
+
+
+class ReservoirSample:
+    """
+    Uniform sample of at most size rows (algorithm R, one chunk at a time)
+    """
+
+    def __init__(self, size, width):
+        self.size = size
+        self.rows = np.empty((0, width))
+        self.seen = 0
+
+    def update(self, values: np.ndarray):
+        fill = min(max(self.size - len(self.rows), 0), len(values))
+        if fill:
+            self.rows = np.concatenate([self.rows, values[:fill]])
+
+        rest = values[fill:]
+        if len(rest):
+            # Row t replaces a random slot with probability size / (t + 1)
+            positions = self.seen + fill + np.arange(len(rest))
+            slots = np.random.default_rng(self.seen).integers(0, positions + 1)
+            replace = slots < self.size
+            self.rows[slots[replace]] = rest[replace]
+
+        self.seen += len(values)
+
+    def to_state(self):
+        return {"sample_rows": self.rows, "sample_seen": np.array(self.seen)}
+
+    @classmethod
+    def from_state(cls, size, state):
+        sample = cls(size, state["sample_rows"].shape[1])
+        sample.rows = state["sample_rows"]
+        sample.seen = int(state["sample_seen"])
+        return sample
@@ -0,0 +1,104 @@
+"""
+Stats access layer
+
+write_stat writes stat.json (unchanged format, numbers as strings) and
+stat.msgpack, a compact binary copy where the metrics are real floats.
+load_stat returns the parsed stats from an in-process LRU validated by the
+mtime and size of the file, so the stats of a session are parsed once per
+process and not once per reader. Sessions uploaded before stat.msgpack
+existed are read from stat.json.
+
+The returned dict is shared between the callers and must not be modified.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+import msgpack
+
+logging.basicConfig(level=logging.INFO)
+
+STAT_FILE_NAME = "stat.json"
+STAT_BINARY_FILE_NAME = "stat.msgpack"
+STAT_CACHE_SIZE = int(os.getenv("STAT_CACHE_SIZE", 64))
+
+# Keys whose values are metrics written as strings in stat.json
+METRIC_KEYS = {"metrics", "stat"}
+
+_cache = OrderedDict()  # path -> (mtime_ns, size, stat)
+_lock = threading.Lock()
+
+
+def to_typed(value, in_metrics=False):
+    """
+    to_typed
+    return a copy of the stats where the metrics are floats instead of strings
+    """
+    if isinstance(value, dict):
+        return {key: to_typed(item, in_metrics or key in METRIC_KEYS) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_typed(item, in_metrics) for item in value]
+    if in_metrics and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    return value
+
+
+def write_stat(stat_file_path, stat):
+    """
+    write_stat
+    write stat.json and its binary copy next to it
+    """
+    stat_file_path = Path(stat_file_path)
+    _write_atomic(stat_file_path, json.dumps(stat).encode())
+    _write_atomic(stat_file_path.with_name(STAT_BINARY_FILE_NAME), msgpack.packb(to_typed(stat)))
+
+
+def load_stat(stat_file_path):
+    """
+    load_stat
+    return the parsed stats of stat_file_path (stat.json), from the binary
+    copy when it exists, cached until the file changes
+    """
+    stat_file_path = Path(stat_file_path)
+    binary_path = stat_file_path.with_name(STAT_BINARY_FILE_NAME)
+    path = binary_path if binary_path.exists() else stat_file_path
+
+    file_stat = path.stat()
+    key = str(path)
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+            _cache.move_to_end(key)
+            return cached[2]
+
+    with open(path, "rb") as f:
+        content = f.read()
+    if path == binary_path:
+        stat = msgpack.unpackb(content, strict_map_key=False)
+    else:
+        stat = to_typed(json.loads(content))
+
+    with _lock:
+        _cache[key] = (file_stat.st_mtime_ns, file_stat.st_size, stat)
+        _cache.move_to_end(key)
+        while len(_cache) > STAT_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return stat
+
+
+def _write_atomic(path, content):
+    # Readers never see a half written file
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,347 @@
+"""
+Descriptive stats of an uploaded dataset (stat.json)
+
+The CSV is read with read_csv(chunksize=...) and every chunk is folded into
+mergeable running aggregates, so peak memory depends on the chunk size and
+not on the file size. The chunks can be written to the columnar copy
+of the dataset in the same pass (see services/columnar.py).
+
+The medians and percentiles are exact up to STAT_EXACT_MAX_VALUES numeric
+values and come from quantile sketches above (see services/sketch.py).
+
+The aggregates are saved to stat_state.npz next to stat.json, so rows
+appended later are folded in without reading the dataset again (see
+services/append_stat.py).
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from services.generate_stat import get_date_field, format_stat, add_year_percentiles
+from services.period_summary import PeriodAggregates
+from services.sketch import NO_YEAR, STAT_PERCENTILES, STAT_QUANTILE_ERROR, STAT_SAMPLE_SIZE, QuantileSketches, ReservoirSample, is_approximate
+from services.correlation import CORRELATION_METHOD, correlation_matrix, moments_to_correlation, sparse_correlation
+from services.date_format import parse_session_dates
+from services.columnar import ColumnarWriter, read_columnar_file
+from services.stat_store import write_stat
+from util.date import parse_date_column
+
+logging.basicConfig(level=logging.INFO)
+
+STAT_CHUNK_SIZE = int(os.getenv("STAT_CHUNK_SIZE", 50_000))
+STAT_STATE_FILE_NAME = "stat_state.npz"
+
+
+def merge_dtype(current, new):
+    """
+    merge_dtype
+    return the dtype read_csv would give a column whose chunks have both dtypes
+    """
+    if current is None or current == new:
+        return new
+
+    both_numeric = pd.api.types.is_numeric_dtype(current) and pd.api.types.is_numeric_dtype(new)
+    has_bool = pd.api.types.is_bool_dtype(current) or pd.api.types.is_bool_dtype(new)
+    if both_numeric and not has_bool:
+        return np.result_type(current, new)
+
+    return np.dtype(object)
+
+
+class StatAccumulator:
+    """
+    Running aggregates over the chunks of one dataset
+
+    - fields: dtype of every column, merged across chunks
+    - start/end date of the date column
+    - per day and field: count, sum, min, max and sum of squares, rolled up
+      to years, months and weeks at the end
+    - pairwise complete co-moments of the numeric fields for Pearson correlation
+    - quantile sketches per field, for the whole dataset and per year
+    - a sample of the rows for the Spearman correlation of large datasets
+    """
+
+    def __init__(self, columns, session_id: str = None):
+        self.columns = list(columns)
+        self.session_id = session_id
+        self.dtypes = {column: None for column in self.columns}
+        self.date_field = get_date_field(self.dtypes)
+        self.start_date = None
+        self.end_date = None
+
+        # Values are shifted by a per column reference to keep the sums precise
+        p = len(self.columns)
+        self.shift = np.full(p, np.nan)
+        self.n = np.zeros((p, p))
+        self.sx = np.zeros((p, p))
+        self.sxx = np.zeros((p, p))
+        self.sxy = np.zeros((p, p))
+
+        self.periods = PeriodAggregates(self.columns)
+        self.rows = 0
+        self.sketches = QuantileSketches(p)
+        self.sample = ReservoirSample(STAT_SAMPLE_SIZE, p)
+
+    @property
+    def approximate(self):
+        return not self.sketches.exact
+
+    def numeric_fields(self):
+        return [
+            column for column in self.columns
+            if column != self.date_field
+            and self.dtypes[column] is not None
+            and pd.api.types.is_numeric_dtype(self.dtypes[column])
+        ]
+
+    def add_chunk(self, chunk: pd.DataFrame):
+        """
+        add_chunk
+        fold the chunk into the aggregates, the date column of the chunk is
+        replaced by the parsed dates
+        """
+        for column, dtype in chunk.dtypes.items():
+            self.dtypes[column] = merge_dtype(self.dtypes[column], dtype)
+
+        dates = self._parse_dates(chunk[self.date_field])
+        chunk[self.date_field] = dates
+        chunk_start, chunk_end = dates.min(), dates.max()
+        if pd.notnull(chunk_start):
+            self.start_date = chunk_start if self.start_date is None else min(self.start_date, chunk_start)
+            self.end_date = chunk_end if self.end_date is None else max(self.end_date, chunk_end)
+
+        # Non numeric columns of this chunk count as missing values, they are
+        # dropped at the end if their merged dtype is not numeric
+        values = np.full((len(chunk), len(self.columns)), np.nan)
+        for i, column in enumerate(self.columns):
+            if column != self.date_field and pd.api.types.is_numeric_dtype(chunk[column].dtype):
+                values[:, i] = chunk[column].to_numpy(dtype=float, na_value=np.nan)
+
+        self._add_moments(values)
+        self.periods.add(values, dates)
+
+        self.rows += len(chunk)
+        # Checked before the chunk is kept, the exact values never go over the limit
+        size = self.sketches.size + int((~np.isnan(values)).sum())
+        if not self.approximate and is_approximate(size):
+            logging.info(f"[StatAccumulator] Over {size} values, switching to approximate quantiles")
+            self.sketches.compress()
+        self.sketches.update(values, dates.dt.year.fillna(NO_YEAR).to_numpy(dtype=np.int32))
+        self.sample.update(values)
+
+    def _parse_dates(self, values):
+        if self.session_id is not None:
+            return parse_session_dates(self.session_id, values)
+        return parse_date_column(values)[0]
+
+    def _add_moments(self, values):
+        valid = ~np.isnan(values)
+
+        new_shift = np.isnan(self.shift) & valid.any(axis=0)
+        if new_shift.any():
+            first_valid = valid.argmax(axis=0)
+            self.shift[new_shift] = values[first_valid, np.arange(values.shape[1])][new_shift]
+
+        x = np.where(valid, values - np.nan_to_num(self.shift), 0.0)
+        mask = valid.astype(float)
+
+        self.n += mask.T @ mask
+        self.sx += x.T @ mask
+        self.sxx += (x * x).T @ mask
+        self.sxy += x.T @ x
+
+    def save(self, path):
+        """
+        save
+        write the aggregates to path (npz), replaced atomically
+        """
+        state = {
+            "columns": np.array(self.columns, dtype=str),
+            "dtypes": np.array([str(self.dtypes[column]) for column in self.columns], dtype=str),
+            "dates": np.array([
+                "" if date is None else str(date) for date in (self.start_date, self.end_date)
+            ], dtype=str),
+            "shift": self.shift,
+            "n": self.n,
+            "sx": self.sx,
+            "sxx": self.sxx,
+            "sxy": self.sxy,
+            "rows": np.array(self.rows),
+            **self.periods.to_state(),
+            **self.sketches.to_state(),
+            **self.sample.to_state(),
+        }
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, session_id: str = None):
+        with np.load(path) as state:
+            accumulator = cls(state["columns"].tolist(), session_id)
+            accumulator.dtypes = {
+                column: np.dtype(dtype) for column, dtype in zip(accumulator.columns, state["dtypes"].tolist())
+            }
+            accumulator.start_date, accumulator.end_date = (
+                pd.Timestamp(date) if date else None for date in state["dates"].tolist()
+            )
+            accumulator.shift = state["shift"]
+            accumulator.n = state["n"]
+            accumulator.sx = state["sx"]
+            accumulator.sxx = state["sxx"]
+            accumulator.sxy = state["sxy"]
+            accumulator.periods = PeriodAggregates.from_state(accumulator.columns, state)
+            accumulator.rows = int(state["rows"])
+            accumulator.sketches = QuantileSketches.from_state(len(accumulator.columns), state)
+            accumulator.sample = ReservoirSample.from_state(STAT_SAMPLE_SIZE, state)
+
+        return accumulator
+
+    def get_fields(self):
+        return {column: str(dtype) for column, dtype in self.dtypes.items()}
+
+    def get_date(self):
+        return {
+            "start_date": str(self.start_date if self.start_date is not None else pd.NaT),
+            "end_date": str(self.end_date if self.end_date is not None else pd.NaT),
+        }
+
+    def get_correlation(self):
+        index = [self.columns.index(field) for field in self.numeric_fields()]
+        n = self.n[np.ix_(index, index)]
+        sx = self.sx[np.ix_(index, index)]
+        sxx = self.sxx[np.ix_(index, index)]
+        sxy = self.sxy[np.ix_(index, index)]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = sxy - sx * sx.T / n
+            var_x = sxx - sx * sx / n
+
+        return sparse_correlation(self.numeric_fields(), moments_to_correlation(cov, var_x, var_x.T, n))
+
+    def get_sample_correlation(self, method="spearman"):
+        fields = self.numeric_fields()
+        index = [self.columns.index(field) for field in fields]
+        return sparse_correlation(fields, correlation_matrix(self.sample.rows[:, index], method))
+
+    def get_stat(self):
+        """
+        get_stat
+        return the whole period metrics of the numeric fields and their
+        percentiles per year, {year: fields x STAT_PERCENTILES array}
+        """
+        fields = self.numeric_fields()
+        index = [self.columns.index(field) for field in fields]
+        n = self.n[index, index]
+        sx = self.sx[index, index]
+        sxx = self.sxx[index, index]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(n > 0, self.shift[index] + sx / n, np.nan)
+            variance = (sxx - sx * sx / n) / (n - 1)
+            sd = np.where(n > 1, np.sqrt(np.clip(variance, 0, None)), np.nan)
+
+        qs = [percentile / 100 for percentile in STAT_PERCENTILES]
+        minimum = np.full(len(fields), np.nan)
+        maximum = np.full(len(fields), np.nan)
+        percentiles = np.full((len(fields), len(qs)), np.nan)
+        year_percentiles = {}
+        for j, i in enumerate(index):
+            summary = self.sketches.summarize(i, qs)
+            if summary is None:
+                continue
+            minimum[j], maximum[j], percentiles[j], by_year = summary
+            for year, values in by_year.items():
+                year_percentiles.setdefault(year, np.full((len(fields), len(qs)), np.nan))[j] = values
+
+        return format_stat(fields, mean, minimum, maximum, sd, percentiles), year_percentiles
+
+    def to_stat(self):
+        data = {}
+        data["fields"] = self.get_fields()
+        data["date"] = self.get_date()
+        data["correlation"] = self.get_correlation()
+        data["stat"], year_percentiles = self.get_stat()
+        data.update(self.periods.to_summaries(self.numeric_fields()))
+        add_year_percentiles(data["summary_by_year"], self.numeric_fields(), year_percentiles)
+        data["stat_mode"] = {
+            "approximate": self.approximate,
+            "quantile_error": STAT_QUANTILE_ERROR if self.approximate else 0,
+        }
+
+        return {"data": data}
+
+
+def accumulate_csv(csv_file_path, session_id: str = None, chunksize: int = STAT_CHUNK_SIZE, columnar_path=None):
+    """
+    accumulate_csv
+    return the StatAccumulator of the CSV, read chunk by chunk
+    with columnar_path the parsed chunks are also written to an Arrow file
+    """
+    accumulator = None
+    writer = ColumnarWriter(columnar_path) if columnar_path is not None else None
+    try:
+        with pd.read_csv(csv_file_path, chunksize=chunksize) as reader:
+            for i, chunk in enumerate(reader):
+                if accumulator is None:
+                    accumulator = StatAccumulator(chunk.columns, session_id)
+
+                logging.info(f"[accumulate_csv] Chunk {i}: {len(chunk)} rows")
+                accumulator.add_chunk(chunk)
+                if writer is not None:
+                    writer.write(chunk)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        writer.close()
+
+    return accumulator
+
+
+def accumulator_to_stat(accumulator, columnar_path=None):
+    stat = accumulator.to_stat()
+    if CORRELATION_METHOD == "spearman":
+        # Ranks need whole columns, they are read back from the Arrow file
+        # or, for large datasets, taken from the sample of the rows
+        if accumulator.approximate:
+            stat["data"]["correlation"] = accumulator.get_sample_correlation()
+        elif columnar_path is None:
+            logging.warning("[accumulator_to_stat] Spearman needs the columnar file, using Pearson")
+        else:
+            fields = accumulator.numeric_fields()
+            values = read_columnar_file(columnar_path, fields).to_numpy(dtype=float, na_value=np.nan)
+            stat["data"]["correlation"] = sparse_correlation(fields, correlation_matrix(values, "spearman"))
+
+    return stat
+
+
+def generate_descriptive_stats_from_csv(csv_file_path, session_id: str = None, chunksize: int = STAT_CHUNK_SIZE, columnar_path=None):
+    """
+    generate_descriptive_stats_from_csv
+    return fields, date range, correlation, stat and period summaries
+    """
+    return accumulator_to_stat(accumulate_csv(csv_file_path, session_id, chunksize, columnar_path), columnar_path)
+
+
+def write_descriptive_stats(csv_file_path, stat_file_path, session_id: str = None, columnar_path=None, state_path=None):
+    """
+    write_descriptive_stats
+    write stat.json, then with state_path the aggregates used by later appends
+    """
+    accumulator = accumulate_csv(csv_file_path, session_id, columnar_path=columnar_path)
+    res = accumulator_to_stat(accumulator, columnar_path)
+
+    write_stat(stat_file_path, res)
+    # Last, an append is only accepted once the state exists and stat.json is final
+    if state_path is not None:
+        accumulator.save(state_path)
+
+    return res
@@ -1,6 +1,8 @@
 import logging
 import datetime
 
+import pandas as pd
+
 logging.basicConfig(level = logging.INFO)
 
 date_time_common_formats = [
@@ -18,12 +20,63 @@ date_time_common_formats = [
     "%A, %B %d, %Y %H:%M:%S", # e.g., "Wednesday, January 25, 2023 10:30:00"
 ]
 
+# Number of values used to sniff the format of a date column
+DATE_SAMPLE_SIZE = 200
+
 def get_date(date):
     for fmt in date_time_common_formats:
         try:
             datetime_object = datetime.datetime.strptime(date, fmt)
             return datetime_object
-        except ValueError:
+        except (ValueError, TypeError):
             continue
-    
-    logging.ERROR("[get_date] Cannot find matching format")
\ No newline at end of file
+
+    logging.error(f"[get_date] Cannot find matching format for {date}")
+
+
+def detect_date_format(values, sample_size=DATE_SAMPLE_SIZE):
+    """
+    detect_date_format
+    return the first common format that parses every value of a sample
+    taken across the column, None if no format matches
+    """
+    sample = pd.Series(values).dropna()
+    if sample.empty:
+        return None
+
+    step = max(1, len(sample) // sample_size)
+    sample = sample.iloc[::step].astype(str)
+
+    for fmt in date_time_common_formats:
+        try:
+            pd.to_datetime(sample, format=fmt)
+            return fmt
+        except (ValueError, TypeError):
+            continue
+
+    logging.warning("[detect_date_format] Cannot find a common format in the sample")
+    return None
+
+
+def parse_date_column(values, date_format=None):
+    """
+    parse_date_column
+    parse the whole column in one vectorized pass with the given (or detected) format
+    return the parsed datetime series and the format used
+    """
+    values = pd.Series(values)
+    if date_format is None:
+        date_format = detect_date_format(values)
+
+    if date_format is None:
+        return pd.to_datetime(values, errors="coerce"), None
+
+    parsed = pd.to_datetime(values, format=date_format, errors="coerce")
+
+    # Rows that do not follow the detected format fall back to the per-value lookup
+    unmatched = parsed.isna() & values.notna()
+    if unmatched.any():
+        logging.info(f"[parse_date_column] {unmatched.sum()} values do not match {date_format}")
+        parsed[unmatched] = pd.to_datetime(values[unmatched].map(get_date), errors="coerce")
+
+    return parsed, date_format
@@ -0,0 +1,95 @@
+"""
+Downsampling of sorted series before plotting or returning them
+
+Both methods return the indices of the points to keep, so the same
+selection can be applied to any other array aligned with the series
+(e.g. the bounds of a confidence band).
+
+- minmax: split the x range into buckets (e.g. one per pixel) and keep the min
+  and the max of each bucket, peaks and drops are kept exactly
+- lttb: Largest-Triangle-Three-Buckets, keeps the point of each bucket that
+  forms the largest triangle with its neighbours
+"""
+
+import numpy as np
+
+DOWNSAMPLE_METHODS = ["minmax", "lttb"]
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[ns]").astype(np.int64).astype(float)
+    return x.astype(float)
+
+
+def minmax_indices(x, y, n_buckets):
+    """
+    minmax_indices
+    return the indices of the min and max point of each bucket of the x range
+    """
+    x, y = _as_float(x), np.asarray(y, dtype=float)
+    n = len(x)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+
+    span = x[-1] - x[0]
+    if span > 0:
+        bucket = np.minimum(((x - x[0]) / span * n_buckets).astype(int), n_buckets - 1)
+    else:
+        bucket = np.zeros(n, dtype=int)
+
+    # x is sorted so every bucket is a contiguous run of points
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    counts = np.diff(np.r_[starts, n])
+    lows = np.repeat(np.minimum.reduceat(y, starts), counts)
+    highs = np.repeat(np.maximum.reduceat(y, starts), counts)
+
+    # First point of each bucket that reaches the min / max
+    min_index = np.flatnonzero(y == lows)
+    max_index = np.flatnonzero(y == highs)
+    min_index = min_index[np.unique(bucket[min_index], return_index=True)[1]]
+    max_index = max_index[np.unique(bucket[max_index], return_index=True)[1]]
+
+    return np.unique(np.r_[0, min_index, max_index, n - 1])
+
+
+def lttb_indices(x, y, n_out):
+    """
+    lttb_indices
+    return the indices of the n_out points selected by Largest-Triangle-Three-Buckets
+    """
+    x, y = _as_float(x), np.asarray(y, dtype=float)
+    n = len(x)
+    if n <= 2 * n_out or n_out < 3:
+        return np.arange(n)
+
+    bounds = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = bounds[i], bounds[i + 1]
+        next_end = bounds[i + 2] if i + 2 < len(bounds) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+
+    return selected
+
+
+def downsample_indices(x, y, n_points, method="minmax"):
+    """
+    downsample_indices
+    return the indices of at most about n_points points of the sorted series (x, y)
+    """
+    if method == "minmax":
+        return minmax_indices(x, y, max(1, n_points // 2))
+    if method == "lttb":
+        return lttb_indices(x, y, n_points)
+
+    raise ValueError(f"Unknown downsample method {method}, expected one of {DOWNSAMPLE_METHODS}")
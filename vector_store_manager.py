@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from chromadb import Client
+from chromadb.config import Settings
+from dotenv import load_dotenv
+
+from redis_manager import SESSION_TTL
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+UPLOAD_ROOT = Path("uploaded_files")
+
+
+class VectorStoreManager:
+    """
+    One in-memory Chroma client for the whole process.
+
+    Every session collection is tracked with its last access time and its
+    approximate size. A collection is evicted when it has not been used for
+    SESSION_TTL seconds (same expiry as the session in Redis) or, least
+    recently used first, when the total goes over VECTOR_STORE_MAX_BYTES.
+    With VECTOR_STORE_PERSIST=true evicted collections are written to
+    uploaded_files/<session_id>/vectors.npz and loaded back on the next access.
+    """
+    _client = None
+    _collections = OrderedDict()  # session_id -> {"last_used": float, "size": int}
+    _lock = threading.RLock()
+
+    max_bytes = int(os.getenv("VECTOR_STORE_MAX_BYTES", 512 * 1024 * 1024))  # 512 MB
+    persist = os.getenv("VECTOR_STORE_PERSIST", "false").lower() == "true"
+
+    @classmethod
+    def get_client(cls):
+        if cls._client is None:
+            cls._client = Client(Settings())
+        return cls._client
+
+    @classmethod
+    def create_collection(cls, session_id):
+        """
+        create_collection
+        return a new empty collection for the session, replacing the existing one
+        """
+        with cls._lock:
+            cls._drop(session_id)
+            cls._persisted_path(session_id).unlink(missing_ok=True)
+            collection = cls.get_client().create_collection(name=session_id)
+            cls._collections[session_id] = {"last_used": time.time(), "size": 0}
+            return collection
+
+    @classmethod
+    def add(cls, session_id, collection, documents, embeddings, metadatas, ids):
+        collection.add(documents=documents, embeddings=embeddings, metadatas=metadatas, ids=ids)
+
+        with cls._lock:
+            entry = cls._collections.setdefault(session_id, {"last_used": time.time(), "size": 0})
+            entry["size"] += cls._estimate_size(documents, embeddings)
+            cls._touch(session_id)
+            cls.evict(keep=session_id)
+
+    @classmethod
+    def delete(cls, session_id, collection, ids):
+        if not ids:
+            return
+
+        deleted = collection.get(ids=ids, include=["documents", "embeddings"])
+        collection.delete(ids=ids)
+
+        with cls._lock:
+            entry = cls._collections.get(session_id)
+            if entry is not None:
+                size = cls._estimate_size(deleted["documents"], deleted["embeddings"])
+                entry["size"] = max(entry["size"] - size, 0)
+                cls._touch(session_id)
+
+    @classmethod
+    def get_collection(cls, session_id):
+        """
+        get_collection
+        return the session collection, loaded back from disk if it was persisted,
+        None when the session has no collection
+        """
+        with cls._lock:
+            cls.evict()
+            if session_id in cls._collections:
+                cls._touch(session_id)
+                return cls.get_client().get_collection(name=session_id)
+
+            if cls._persisted_path(session_id).exists():
+                return cls._restore(session_id)
+
+            return None
+
+    @classmethod
+    def evict(cls, keep=None):
+        with cls._lock:
+            now = time.time()
+            for session_id, entry in list(cls._collections.items()):
+                if session_id != keep and now - entry["last_used"] > SESSION_TTL:
+                    logging.info(f"[VectorStoreManager] Session {session_id} expired")
+                    cls._evict_one(session_id)
+
+            # Least recently used first, the OrderedDict is kept in access order
+            for session_id in list(cls._collections):
+                if cls.total_size() <= cls.max_bytes:
+                    break
+                if session_id == keep:
+                    continue
+                logging.info(f"[VectorStoreManager] Memory budget exceeded, evicting {session_id}")
+                cls._evict_one(session_id)
+
+    @classmethod
+    def total_size(cls):
+        return sum(entry["size"] for entry in cls._collections.values())
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                "collections": len(cls._collections),
+                "size_bytes": cls.total_size(),
+                "max_bytes": cls.max_bytes,
+                "persist": cls.persist,
+            }
+
+    @classmethod
+    def _touch(cls, session_id):
+        cls._collections[session_id]["last_used"] = time.time()
+        cls._collections.move_to_end(session_id)
+
+    @classmethod
+    def _evict_one(cls, session_id):
+        if cls.persist:
+            cls._save(session_id)
+        cls._drop(session_id)
+
+    @classmethod
+    def _drop(cls, session_id):
+        cls._collections.pop(session_id, None)
+        try:
+            cls.get_client().delete_collection(name=session_id)
+        except Exception:
+            pass
+
+    @classmethod
+    def _persisted_path(cls, session_id):
+        return UPLOAD_ROOT/session_id/"vectors.npz"
+
+    @classmethod
+    def _save(cls, session_id):
+        try:
+            collection = cls.get_client().get_collection(name=session_id)
+            data = collection.get(include=["embeddings", "documents", "metadatas"])
+        except Exception as e:
+            logging.error(f"[VectorStoreManager] Cannot persist {session_id}: {e}")
+            return
+
+        path = cls._persisted_path(session_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            ids=np.array(data["ids"]),
+            embeddings=np.asarray(data["embeddings"], dtype=np.float32),
+            documents=np.array(data["documents"]),
+            metadatas=np.array(json.dumps(data["metadatas"])),
+        )
+        logging.info(f"[VectorStoreManager] Persisted {session_id} to {path}")
+
+    @classmethod
+    def _restore(cls, session_id):
+        logging.info(f"[VectorStoreManager] Loading {session_id} from disk")
+        with np.load(cls._persisted_path(session_id)) as data:
+            ids = data["ids"].tolist()
+            embeddings = data["embeddings"]
+            documents = data["documents"].tolist()
+            metadatas = json.loads(data["metadatas"].item())
+
+        collection = cls.get_client().create_collection(name=session_id)
+        cls._collections[session_id] = {"last_used": time.time(), "size": 0}
+        if ids:
+            cls.add(session_id, collection, documents, embeddings, metadatas, ids)
+        return collection
+
+    @staticmethod
+    def _estimate_size(documents, embeddings):
+        # Chroma keeps the vectors as float32
+        vector_bytes = sum(len(embedding) * 4 for embedding in embeddings)
+        document_bytes = sum(len(document.encode()) for document in documents)
+        return vector_bytes + document_bytes
@@ -0,0 +1,118 @@
+"""
+Websocket backplane
+
+The process that runs a pipeline is often not the one holding the session
+websocket (several uvicorn workers or replicas). send_message publishes on
+the channel ws:<session_id> and every worker subscribes to the channels of
+the sessions it holds, so the message reaches the socket wherever it is.
+
+WEBSOCKET_BACKPLANE selects the implementation:
+- redis: Redis pub/sub, for several workers or nodes
+- memory: delivery inside the process, for a single worker and for tests
+"""
+
+import asyncio
+import logging
+import os
+
+from redis_manager import RedisManager
+
+logging.basicConfig(level=logging.INFO)
+
+WEBSOCKET_BACKPLANE = os.getenv("WEBSOCKET_BACKPLANE", "redis")
+CHANNEL_PREFIX = "ws:"
+
+
+def session_channel(session_id):
+    return f"{CHANNEL_PREFIX}{session_id}"
+
+
+class MemoryBackplane:
+    def __init__(self):
+        self.handler = None
+        self.sessions = set()
+
+    async def subscribe(self, session_id):
+        self.sessions.add(session_id)
+
+    async def unsubscribe(self, session_id):
+        self.sessions.discard(session_id)
+
+    async def publish(self, session_id, message):
+        """
+        publish
+        return the number of subscribers that received the message
+        """
+        if session_id not in self.sessions:
+            return 0
+        await self.handler(session_id, message)
+        return 1
+
+    async def close(self):
+        self.sessions.clear()
+
+
+class RedisBackplane:
+    # Seconds a listener waits for a message before checking again
+    poll_timeout = 1.0
+
+    def __init__(self):
+        self.handler = None
+        self._pubsub = None
+        self._listener = None
+
+    async def subscribe(self, session_id):
+        if self._pubsub is None:
+            self._pubsub = RedisManager.get_client().pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(session_channel(session_id))
+
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def unsubscribe(self, session_id):
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(session_channel(session_id))
+
+    async def publish(self, session_id, message):
+        return await RedisManager.get_client().publish(session_channel(session_id), message)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    async def _listen(self):
+        # One listener per process, messages of a session are delivered in order
+        while True:
+            if not self._pubsub.subscribed:
+                await asyncio.sleep(self.poll_timeout)
+                continue
+
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=self.poll_timeout)
+            except Exception as e:
+                logging.error(f"[RedisBackplane] Cannot read from pub/sub: {e}")
+                await asyncio.sleep(self.poll_timeout)
+                continue
+
+            if message is None or message["type"] != "message":
+                continue
+
+            session_id = message["channel"][len(CHANNEL_PREFIX):]
+            try:
+                await self.handler(session_id, message["data"])
+            except Exception as e:
+                logging.error(f"[RedisBackplane] Cannot deliver the message to {session_id}: {e}")
+
+
+def create_backplane(kind=WEBSOCKET_BACKPLANE):
+    if kind == "redis":
+        return RedisBackplane()
+    if kind == "memory":
+        return MemoryBackplane()
+
+    raise ValueError(f"Unknown websocket backplane {kind}, expected redis or memory")
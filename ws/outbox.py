@@ -0,0 +1,84 @@
+"""
+Per-session outbox
+
+Every durable websocket message is appended to the Redis stream
+outbox:<session_id> before it is published, so a result computed while the
+client is not connected is not lost. The stream expires with the session
+and keeps at most OUTBOX_MAX_LEN messages, none older than OUTBOX_MAX_AGE
+seconds (the session TTL by default). The client acknowledges messages by id
+(cumulative, everything up to the id is dropped) and the messages that are
+still pending are sent again, in order, when the socket (re)connects. A
+client that does not send acks can pass the last id it has seen when it
+connects, only the newer messages are replayed.
+"""
+
+import os
+import time
+
+from dotenv import load_dotenv
+
+from redis_manager import RedisManager, SESSION_TTL
+
+load_dotenv()
+
+
+def parse_message_id(message_id):
+    milliseconds, sequence = message_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+def is_message_id(message_id):
+    try:
+        parse_message_id(message_id)
+    except (AttributeError, ValueError):
+        return False
+    return True
+
+
+class Outbox:
+    enabled = os.getenv("WEBSOCKET_OUTBOX", "true").lower() == "true"
+    max_len = int(os.getenv("OUTBOX_MAX_LEN", 100))
+    max_age = int(os.getenv("OUTBOX_MAX_AGE", SESSION_TTL))
+
+    @staticmethod
+    def key(session_id):
+        return f"outbox:{session_id}"
+
+    @classmethod
+    def min_id(cls):
+        # Stream ids start with the time they were added, in milliseconds
+        return f"{int(time.time() * 1000) - cls.max_age * 1000}-0"
+
+    @classmethod
+    async def append(cls, session_id, message):
+        """
+        append
+        add the message to the outbox of the session, return its id
+        """
+        async with RedisManager.get_client().pipeline(transaction=True) as pipe:
+            pipe.xadd(cls.key(session_id), {"message": message}, maxlen=cls.max_len, approximate=True)
+            pipe.xtrim(cls.key(session_id), minid=cls.min_id(), approximate=True)
+            pipe.expire(cls.key(session_id), SESSION_TTL)
+            message_id, _, _ = await pipe.execute()
+        return message_id
+
+    @classmethod
+    async def pending(cls, session_id, after=None):
+        """
+        pending
+        return the (id, message) not acknowledged yet and newer than after,
+        oldest first, without the messages older than max_age
+        """
+        start = cls.min_id()
+        if after is not None and parse_message_id(after) >= parse_message_id(start):
+            start = f"({after}"
+        entries = await RedisManager.get_client().xrange(cls.key(session_id), min=start)
+        return [(message_id, fields["message"]) for message_id, fields in entries]
+
+    @classmethod
+    async def ack(cls, session_id, message_id):
+        # MINID drops the older entries, XDEL the acknowledged one
+        async with RedisManager.get_client().pipeline(transaction=True) as pipe:
+            pipe.xtrim(cls.key(session_id), minid=message_id, approximate=False)
+            pipe.xdel(cls.key(session_id), message_id)
+            await pipe.execute()
@@ -1,40 +1,198 @@
+import asyncio
+import json
 import logging
 
 from fastapi import WebSocket, APIRouter, WebSocketDisconnect
 
+from ws.backplane import create_backplane
+from ws.outbox import Outbox, is_message_id, parse_message_id
+
 router = APIRouter()
 
 logging.basicConfig(level=logging.INFO)
 
 class ConnectionManager:
-    def __init__(self):
+    """
+    Keeps the websockets of this process, messages go through the backplane
+    so they reach the socket even when it is held by another worker.
+
+    Durable messages are written to the session outbox first and carry its
+    id, the pending ones are replayed when the socket connects (only the ones
+    after last_id when the client passes the last id it has seen). Messages
+    already sent on the current socket are not sent twice.
+    """
+    def __init__(self, backplane=None):
         self.active_connections: dict[str, WebSocket] = {}
+        self.last_delivered: dict[str, str] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.backplane = backplane or create_backplane()
+        self.backplane.handler = self.deliver
 
-    async def connect(self, websocket: WebSocket, session_id: str):
+    async def connect(self, websocket: WebSocket, session_id: str, last_id: str = None):
         await websocket.accept()
         self.active_connections[session_id] = websocket
+        self.last_delivered.pop(session_id, None)
+        lock = self.locks.setdefault(session_id, asyncio.Lock())
+
+        # Live messages wait for the lock until the replay is done, otherwise
+        # a newer id would be sent first and the older pending ones skipped
+        async with lock:
+            try:
+                await self.backplane.subscribe(session_id)
+            except Exception as e:
+                logging.warning(f"[Websocket] Cannot subscribe {session_id} to the backplane: {e}")
+
+            # The client has seen everything up to last_id, acknowledged as if it sent the ack
+            if last_id is not None and Outbox.enabled:
+                await self.ack(session_id, last_id)
+
+            # Subscribe first, what is not in the outbox yet arrives through the backplane
+            await self.replay(session_id, last_id)
+
+    async def disconnect(self, session_id: str, websocket: WebSocket = None):
+        # A reconnect may already have replaced the socket of the session
+        if websocket is not None and self.active_connections.get(session_id) is not websocket:
+            return
 
-    def disconnect(self, session_id: str):
         self.active_connections.pop(session_id, None)
+        self.last_delivered.pop(session_id, None)
+        self.locks.pop(session_id, None)
+        try:
+            await self.backplane.unsubscribe(session_id)
+        except Exception as e:
+            logging.warning(f"[Websocket] Cannot unsubscribe {session_id} from the backplane: {e}")
 
-    async def send_message(self, session_id: str, message: str):
+    async def send_message(self, session_id: str, message: str, durable: bool = True):
+        """
+        send_message
+        send the message to the session wherever its socket is, durable
+        messages are kept in the outbox until the client acknowledges them
+        """
         logging.info(f"[Websocket] Send message: {message} to Session: {session_id}")
+        message_id = None
+        if durable and Outbox.enabled:
+            try:
+                message_id = await Outbox.append(session_id, message)
+            except Exception as e:
+                logging.warning(f"[Websocket] Cannot write to the outbox of {session_id}: {e}")
+
+        envelope = json.dumps({"id": message_id, "message": message})
+        try:
+            receivers = await self.backplane.publish(session_id, envelope)
+        except Exception as e:
+            logging.warning(f"[Websocket] Cannot publish to the backplane, delivering locally: {e}")
+            await self.deliver(session_id, envelope)
+            return
+
+        if not receivers:
+            if message_id is not None:
+                logging.info(f"[Websocket] Session {session_id} is not connected, message kept in the outbox")
+            else:
+                logging.error(f"No websocket found for Session: {session_id}")
+
+    async def deliver(self, session_id: str, envelope: str):
+        """
+        deliver
+        send the published message to the socket of the session if this process holds it
+        """
+        envelope = json.loads(envelope)
+        lock = self.locks.get(session_id)
+        if lock is None:
+            logging.error(f"No websocket found for Session: {session_id}")
+            return
+
+        async with lock:
+            await self._send(session_id, envelope["id"], envelope["message"])
+
+    async def replay(self, session_id: str, last_id: str = None):
+        """
+        replay
+        send the pending messages of the outbox newer than last_id, the caller
+        holds the session lock
+        """
+        if not Outbox.enabled:
+            return
+
+        try:
+            pending = await Outbox.pending(session_id, last_id)
+        except Exception as e:
+            logging.warning(f"[Websocket] Cannot read the outbox of {session_id}: {e}")
+            return
+
+        if pending:
+            logging.info(f"[Websocket] Replaying {len(pending)} messages to Session: {session_id}")
+        for message_id, message in pending:
+            await self._send(session_id, message_id, message)
+
+    async def ack(self, session_id: str, message_id: str):
+        try:
+            await Outbox.ack(session_id, message_id)
+        except Exception as e:
+            logging.warning(f"[Websocket] Cannot acknowledge {message_id} of {session_id}: {e}")
+
+    async def close(self):
+        await self.backplane.close()
+
+    async def _send(self, session_id, message_id, message):
         websocket = self.active_connections.get(session_id)
-        logging.info(f"Websocket: {websocket}")
-        if websocket:
-            await websocket.send_text(message)
-        else:
-            logging.error(f"No websocket: {websocket} found")
+        if not websocket:
+            logging.error(f"No websocket found for Session: {session_id}")
+            return
+
+        if message_id is not None:
+            last = self.last_delivered.get(session_id)
+            if last is not None and parse_message_id(message_id) <= parse_message_id(last):
+                return  # already sent by the replay
+            self.last_delivered[session_id] = message_id
+            message = with_message_id(message, message_id)
+
+        await websocket.send_text(message)
+
+
+def with_message_id(message: str, message_id: str):
+    """
+    with_message_id
+    add the outbox id to a JSON message so the client can acknowledge it
+    """
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return message
+    if not isinstance(payload, dict):
+        return message
+
+    return json.dumps({"id": message_id, **payload})
+
+
+def parse_ack(data: str):
+    """
+    parse_ack
+    return the acknowledged id of a {"ack": "<id>"} client message, None for other messages
+    """
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return None
+
+    return payload.get("ack") if isinstance(payload, dict) else None
 
 
 websocket_manager = ConnectionManager()
 
 @router.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
-    await websocket_manager.connect(websocket, session_id)
+    # ?last_id=<id> skips the replay of the messages the client already has
+    last_id = websocket.query_params.get("last_id")
+    if last_id is not None and not is_message_id(last_id):
+        last_id = None
+    await websocket_manager.connect(websocket, session_id, last_id)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket_manager.send_message(session_id, f"You wrote: {data}")
+            message_id = parse_ack(data)
+            if message_id is not None:
+                await websocket_manager.ack(session_id, message_id)
+                continue
+            await websocket_manager.send_message(session_id, f"You wrote: {data}", durable=False)
     except WebSocketDisconnect:
-        websocket_manager.disconnect(session_id)
\ No newline at end of file
+        await websocket_manager.disconnect(session_id, websocket)